@@ -0,0 +1,118 @@
+"""Admission control for chat requests
+
+Two independent limits protect the upstream and the workers:
+
+- ``UserRateLimiter``: a token bucket per user (``rate`` requests/second,
+  bursts of up to ``burst``) so a single client cannot monopolize a worker.
+- ``ConcurrencyLimiter``: at most ``max_in_flight`` upstream calls per worker.
+  Further callers wait in a queue of at most ``max_queue`` for up to
+  ``queue_timeout`` seconds; beyond that they are turned away at once instead
+  of piling up behind a throttled upstream.
+
+Rejections raise ``RateLimited`` (HTTP 429) or ``Overloaded`` (HTTP 503), both
+carrying a ``retry_after`` hint in seconds.
+"""
+import os, math, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import counter
+
+CHAT_USER_RATE = float(os.getenv("CHAT_USER_RATE", "1"))  # requests per second per user, 0 disables
+CHAT_USER_BURST = float(os.getenv("CHAT_USER_BURST", "5"))
+CHAT_USER_BUCKETS = int(os.getenv("CHAT_USER_BUCKETS", "10000"))  # users tracked per worker
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "5"))
+
+ADMISSION_REJECTED = counter("admission_rejected_total", "Requests turned away by admission control", ["reason"])
+
+
+class AdmissionError(Exception):
+    status_code = 503
+
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason
+        ADMISSION_REJECTED.inc(reason=reason)
+
+
+class RateLimited(AdmissionError):
+    status_code = 429
+
+
+class Overloaded(AdmissionError):
+    status_code = 503
+
+
+class UserRateLimiter:
+    def __init__(self, rate=CHAT_USER_RATE, burst=CHAT_USER_BURST, max_users=CHAT_USER_BUCKETS):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_users = max_users
+        self._buckets = OrderedDict()  # user -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def check(self, user_id):
+        """Take one token from the user's bucket or raise ``RateLimited``"""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(user_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[user_id] = (tokens, now)
+            # Forgetting the least recently seen user only ever gives them a full bucket
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        if not allowed:
+            raise RateLimited("Too many messages, please slow down.", (1 - tokens) / self.rate, "user_rate")
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_in_flight, max_queue=LLM_MAX_QUEUE, queue_timeout=LLM_QUEUE_TIMEOUT):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiting = 0
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the ``max_in_flight`` slots, waiting in the bounded queue if needed"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self._waiting >= self.max_queue:
+                    raise Overloaded("The server is busy, please try again shortly.",
+                                     self.queue_timeout, "queue_full")
+                self._waiting += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+            if not acquired:
+                raise Overloaded("The server is busy, please try again shortly.",
+                                 self.queue_timeout, "queue_timeout")
+        with self._lock:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue
+            }
@@ -1,14 +1,86 @@
-import os, json, random, requests, time, uuid
-from flask import Flask, render_template, request, jsonify, make_response
-import boto3
+import os, re, json, math, random, requests, time, uuid, atexit, hashlib, logging, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, closing
+from flask import Flask, render_template, request, jsonify, make_response, Response, stream_with_context, g, send_file, url_for
+from flask import before_render_template, template_rendered
 from botocore.exceptions import ClientError, EndpointConnectionError
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+from admission import AdmissionError, UserRateLimiter
+from avatar_cache import AvatarCache
+from character_registry import CharacterRegistry, image_key as character_image_key
+from context import ContextBuilder
+from history_cache import HistoryCache
+from history_scan import history_scan_command
+from idempotency import SingleFlight, IdempotencyMismatch
+from health import HealthMonitor
+from history_store import HistoryStore
+from llm_client import upstream, parse_retry_after
+from llm_router import LLMRouter
+from log import setup_logging
+import metrics
+from reply_cache import ReplyCache
+from storage import S3_BUCKET, AWS_REGION, get_s3_client, bootstrap_bucket
+from url_cache import PresignedUrlCache
+from ws_session import ChatSession, SessionRegistry
+
+try:
+    from flask_sock import Sock
+    from simple_websocket import ConnectionClosed
+except ImportError:  # optional, /ws/chat is only served when installed
+    Sock = None
+
+setup_logging()
+log = logging.getLogger(__name__)
+access_log = logging.getLogger("access")
+
 app = Flask(__name__)
 
+@app.before_request
+def start_health_checks():
+    health_monitor.ensure_running()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    g.user_id = request.cookies.get("user_id")
+
+@app.after_request
+def observe_request_time(response):
+    """Record total request time once the body (including streamed SSE) has been sent"""
+    started = g.get("request_started")
+    if started is not None:
+        labels = {
+            "endpoint": request.url_rule.rule if request.url_rule else "unmatched",
+            "method": request.method,
+            "status": response.status_code
+        }
+        fields = {"request_id": g.request_id, "user_id": g.user_id, "path": request.path, **labels}
+        response.headers["X-Request-ID"] = g.request_id
+
+        def finished():
+            elapsed = time.perf_counter() - started
+            metrics.HTTP_REQUEST_SECONDS.observe(elapsed, **labels)
+            access_log.info("request finished", extra={**fields, "duration_ms": round(elapsed * 1000, 2)})
+
+        response.call_on_close(finished)
+    return response
+
+def start_template_timer(sender, template, context, **extra):
+    g.template_started = time.perf_counter()
+
+def observe_template_time(sender, template, context, **extra):
+    started = g.pop("template_started", None)
+    if started is not None:
+        metrics.TEMPLATE_RENDER_SECONDS.observe(time.perf_counter() - started, template=template.name)
+
+before_render_template.connect(start_template_timer, app)
+template_rendered.connect(observe_template_time, app)
+
 # Custom template filter for timestamps
 @app.template_filter('datetime')
 def format_datetime(timestamp):
@@ -18,618 +90,1001 @@ def format_datetime(timestamp):
 CHUTES_API_KEY = os.getenv("CHUTES_API_KEY")
 CHUTES_BASE_URL = os.getenv("CHUTES_BASE_URL", "https://llm.chutes.ai/v1/chat/completions")
 
-# S3 Configuration
-S3_BUCKET = os.getenv("S3_BUCKET")
-AWS_REGION = os.getenv("AWS_REGION", "ap-southeast-2")
+CHARACTER_MODEL = os.getenv("CHARACTER_MODEL", "deepseek-ai/DeepSeek-V3-0324")  # update to your desired model
+DEMO_MODE = os.getenv("DEMO_MODE", "true").lower() == "true"
 
-# Initialize S3 client
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-    region_name=AWS_REGION
-)
+# Character roster, indexed by name/slug and reloaded when characters.json changes
+character_registry = CharacterRegistry()
+INDEX_CHARACTER_LIMIT = int(os.getenv("INDEX_CHARACTER_LIMIT", "100"))
 
-def setup_s3_bucket():
-    """Configure S3 bucket with CORS and public read access"""
-    if not S3_BUCKET:
-        print("No S3 bucket configured")
-        return
-    
-    try:
-        # Configure CORS
-        cors_configuration = {
-            'CORSRules': [{
-                'AllowedHeaders': ['*'],
-                'AllowedMethods': ['GET', 'HEAD'],
-                'AllowedOrigins': ['*'],
-                'ExposeHeaders': ['ETag'],
-                'MaxAgeSeconds': 3000
-            }]
-        }
-        
-        # Set CORS configuration
-        s3_client.put_bucket_cors(Bucket=S3_BUCKET, CORSConfiguration=cors_configuration)
-        print(f"Successfully configured CORS for bucket: {S3_BUCKET}")
-
-        # Set bucket policy for public read access
-        bucket_policy = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Sid": "PublicReadForGetBucketObjects",
-                    "Effect": "Allow",
-                    "Principal": "*",
-                    "Action": "s3:GetObject",
-                    "Resource": f"arn:aws:s3:::{S3_BUCKET}/character_images/*"
-                }
-            ]
-        }
-        
-        # Convert policy to JSON string
-        bucket_policy_string = json.dumps(bucket_policy)
-        
-        # Set the bucket policy
-        s3_client.put_bucket_policy(Bucket=S3_BUCKET, Policy=bucket_policy_string)
-        print(f"Successfully set bucket policy for: {S3_BUCKET}")
-        
-    except Exception as e:
-        print(f"Error configuring S3 bucket: {e}")
+@app.cli.command("bootstrap-s3")
+def bootstrap_s3_command():
+    """Apply the bucket CORS rules and public-read policy for character images (run once per deploy)."""
+    if not bootstrap_bucket():
+        raise SystemExit(1)
 
-# Set up S3 bucket when app starts
-setup_s3_bucket()
+app.cli.add_command(history_scan_command)
 
-def configure_s3_cors():
-    """Configure CORS for S3 bucket to allow image access"""
-    if not S3_BUCKET:
-        print("No S3 bucket configured")
-        return
-    
-    try:
-        cors_configuration = {
-            'CORSRules': [{
-                'AllowedHeaders': ['*'],
-                'AllowedMethods': ['GET', 'HEAD'],
-                'AllowedOrigins': ['*'],  # In production, replace with specific origins
-                'ExposeHeaders': ['ETag'],
-                'MaxAgeSeconds': 3000
-            }]
-        }
-        
-        s3_client.put_bucket_cors(Bucket=S3_BUCKET, CORSConfiguration=cors_configuration)
-        print(f"Successfully configured CORS for bucket: {S3_BUCKET}")
-    except Exception as e:
-        print(f"Error configuring CORS: {e}")
+# Presigned URLs are reused until shortly before they expire
+url_cache = PresignedUrlCache()
 
-# Configure CORS when app starts
-configure_s3_cors()
+# Avatars are fetched from S3 once and served (and resized) from local disk
+avatar_cache = AvatarCache(S3_BUCKET)
+AVATAR_MAX_AGE = int(os.getenv("AVATAR_MAX_AGE", "86400"))
 
-# S3 and AWS Configuration
-S3_BUCKET = os.getenv("S3_BUCKET")
-AWS_REGION = os.getenv("AWS_REGION", "us-east-1")  # Default to us-east-1 if not specified
-CHARACTER_MODEL = os.getenv("CHARACTER_MODEL", "deepseek-ai/DeepSeek-V3-0324")  # update to your desired model
-DEMO_MODE = os.getenv("DEMO_MODE", "true").lower() == "true"
 
-# Load characters
-with open("characters.json") as f:
-    characters = json.load(f)
+history_store = HistoryStore(S3_BUCKET)
 
-# S3 client initialization with error handling
-try:
-    s3_client = boto3.client("s3", region_name=AWS_REGION)
-    # Test the connection by listing buckets
-    s3_client.list_buckets()
-except Exception as e:
-    print(f"Warning: Failed to initialize S3 client: {e}")
-    print("Chat history will not be saved.")
-    s3_client = None
-
-def fetch_avatar_url(key):
-    try:
-        return s3_client.generate_presigned_url("get_object", Params={"Bucket": S3_BUCKET, "Key": key}, ExpiresIn=3600)
-    except Exception:
-        return None
+def report_s3_error(e, action):
+    """Log a readable explanation for a failed chat history operation"""
+    if isinstance(e, ClientError):
+        error_code = e.response['Error'].get('Code', '')
+        if error_code == 'NoSuchBucket':
+            log.error("The S3 bucket %s does not exist", S3_BUCKET)
+        elif error_code == 'AccessDenied':
+            log.error("Access denied to S3 bucket. Please check your AWS credentials and permissions")
+        else:
+            log.error("AWS error %s %s chat history: %s", error_code, action, e)
+    elif isinstance(e, EndpointConnectionError):
+        log.error("S3 connection error, please check your AWS_REGION configuration: %s", e)
+    else:
+        log.error("Error %s chat history: %s", action, e)
+
+# Write-behind cache: appends return immediately and are flushed in the background
+history_cache = HistoryCache(history_store, on_flush_error=lambda e: report_s3_error(e, "saving"))
+atexit.register(history_cache.drain)
 
 def load_chat_history(user_id):
     if not S3_BUCKET:
-        print("No S3 bucket configured")
+        log.debug("No S3 bucket configured")
         return []
     try:
-        print(f"Loading chat history for user {user_id} from bucket {S3_BUCKET}")
-        response = s3_client.get_object(Bucket=S3_BUCKET, Key=f"chat_history/{user_id}.json")
-        history = json.loads(response['Body'].read().decode('utf-8'))
-        print(f"Successfully loaded {len(history)} messages from chat history")
-        return history
-    except ClientError as e:
-        error_code = e.response['Error'].get('Code', '')
-        if error_code == 'NoSuchKey':
-            # This is normal for new users
-            return []
-        elif error_code == 'NoSuchBucket':
-            print(f"Error: The S3 bucket '{S3_BUCKET}' does not exist")
-        elif error_code == 'AccessDenied':
-            print("Error: Access denied to S3 bucket. Please check your AWS credentials and permissions")
-        else:
-            print(f"AWS Error: {error_code} - {e}")
-        return []
-    except EndpointConnectionError as e:
-        print(f"S3 Connection Error: Please check your AWS_REGION configuration. {e}")
-        return []
+        return history_cache.load(user_id)
     except Exception as e:
-        print(f"Error loading chat history: {e}")
+        report_s3_error(e, "loading")
         return []
 
-def save_chat_history(user_id, history):
+def append_chat_history(user_id, messages):
+    """Append new messages without rewriting the stored history"""
     if not S3_BUCKET:
-        print("No S3 bucket configured, skipping chat history save")
+        log.debug("No S3 bucket configured, skipping chat history save")
         return
     try:
-        print(f"Saving {len(history)} messages for user {user_id} to bucket {S3_BUCKET}")
-        s3_client.put_object(
-            Bucket=S3_BUCKET,
-            Key=f"chat_history/{user_id}.json",
-            Body=json.dumps(history, ensure_ascii=False),
-            ContentType='application/json'
-        )
-        print("Successfully saved chat history")
-    except ClientError as e:
-        error_code = e.response['Error'].get('Code', '')
-        if error_code == 'NoSuchBucket':
-            print(f"Error: The S3 bucket '{S3_BUCKET}' does not exist")
-        elif error_code == 'AccessDenied':
-            print("Error: Access denied to S3 bucket. Please check your AWS credentials and permissions")
-        else:
-            print(f"AWS Error: {error_code} - {e}")
-    except EndpointConnectionError as e:
-        print(f"S3 Connection Error: Please check your AWS_REGION configuration. {e}")
+        history_cache.append(user_id, messages)
     except Exception as e:
-        print(f"Error saving chat history: {e}")
+        report_s3_error(e, "saving")
+
+@app.route("/avatars/<character>")
+def avatar(character):
+    """Character avatar at a stable URL, ``?size=`` picks a thumbnail no smaller than that many pixels"""
+    char = character_registry.get(character)
+    if not char or not S3_BUCKET:
+        return jsonify({'error': 'Avatar not found'}), 404
+    try:
+        image = avatar_cache.get(char['image_key'], request.args.get('size', type=int))
+    except Exception as e:
+        log.exception("Error loading avatar %s", char['image_key'])
+        return jsonify({'error': 'Avatar unavailable', 'message': str(e)}), 502
+    if image is None:
+        response = jsonify({'error': 'Avatar not found'})
+        response.status_code = 404
+        response.cache_control.max_age = avatar_cache.missing_ttl
+        return response
+    return send_file(image.path, mimetype=image.mimetype, etag=image.etag, conditional=True, max_age=AVATAR_MAX_AGE)
 
 @app.route("/get_character_image", methods=['POST'])
 def get_character_image():
     data = request.get_json()
     character = data.get('character')
-    if not character:
+    if not character or not isinstance(character, str):
         return jsonify({'error': 'Character name is required'}), 400
 
-    # Generate the image key - convert to lowercase and replace spaces with underscores
-    image_key = f"character_images/{character.lower().replace(' ', '_')}.jpg"
-    print(f"Looking for image: {image_key} in bucket: {S3_BUCKET}")
+    # Registered characters carry a precomputed key, anything else uses the same naming rule
+    char = character_registry.get(character)
+    image_key = char['image_key'] if char else character_image_key(character)
 
     try:
-        if not s3_client:
-            print("S3 client not initialized")
-            return jsonify({'error': 'S3 client not initialized'}), 500
-        
         if not S3_BUCKET:
-            print("S3 bucket not configured")
+            log.warning("S3 bucket not configured")
             return jsonify({'error': 'S3 bucket not configured'}), 500
 
-        # Check if image exists in S3
+        # Check if image exists in S3 and sign a URL, both cached until shortly before expiry
         try:
-            print("Checking if image exists in S3...")
-            s3_client.head_object(Bucket=S3_BUCKET, Key=image_key)
-            print("Image found, generating URL...")
-            
-            # Generate a pre-signed URL with longer expiration
-            image_url = s3_client.generate_presigned_url(
-                'get_object',
-                Params={
-                    'Bucket': S3_BUCKET,
-                    'Key': image_key,
-                    'ResponseContentType': 'image/jpeg'
-                },
-                ExpiresIn=86400  # URL expires in 24 hours
+            image_url, expires_at = url_cache.presign(
+                get_s3_client(),
+                S3_BUCKET,
+                image_key,
+                expires_in=86400,  # URL expires in 24 hours
+                params={'ResponseContentType': 'image/jpeg'},
+                check_exists=True
             )
-            
-            print(f"Generated URL: {image_url}")
-            
-            # Verify URL is accessible
-            try:
-                requests.head(image_url)
-                print("URL is accessible")
-            except requests.exceptions.RequestException as e:
-                print(f"Warning: URL may not be accessible: {e}")
-            
-            return jsonify({
-                'image_url': image_url,
-                'bucket': S3_BUCKET,
-                'key': image_key,
-                'expires_in': '24 hours'
-            })
-            
         except ClientError as e:
             error_code = e.response['Error'].get('Code', '')
             error_message = e.response['Error'].get('Message', '')
-            print(f"S3 error: {error_code} - {error_message}")
-            
-            if error_code == '404':
-                return jsonify({
-                    'image_url': None,
-                    'error': 'Image not found',
-                    'key': image_key
-                }), 404
-            else:
-                return jsonify({
-                    'error': f'S3 error: {error_code}',
-                    'message': error_message,
-                    'key': image_key
-                }), 500
-                
+            log.warning("S3 error for %s: %s - %s", image_key, error_code, error_message)
+            return jsonify({
+                'error': f'S3 error: {error_code}',
+                'message': error_message,
+                'key': image_key
+            }), 500
+
+        if image_url is None:
+            return jsonify({
+                'image_url': None,
+                'error': 'Image not found',
+                'key': image_key
+            }), 404
+
+        return jsonify({
+            'image_url': image_url,
+            'bucket': S3_BUCKET,
+            'key': image_key,
+            'expires_in': f'{int(expires_at - time.time())} seconds'
+        })
+
     except Exception as e:
-        print(f"Error handling character image: {type(e).__name__} - {str(e)}")
+        log.exception("Error handling character image %s", image_key)
         return jsonify({
             'error': 'Internal server error',
             'message': str(e),
             'key': image_key
         }), 500
 
+# (roster version, rendered page, ETag) of the last index page rendered
+_index_page = None
+
+def render_index_page():
+    """The index page for the current roster, rendered once per roster version"""
+    global _index_page
+    version = character_registry.version
+    cached = _index_page
+    # In debug mode templates are edited in place, so always render
+    if cached and cached[0] == version and not app.debug:
+        return cached
+
+    # Only the first page of the roster is rendered, the rest is found via /api/characters
+    total, chars = character_registry.search(limit=INDEX_CHARACTER_LIMIT)
+    log.debug("Prepared %d of %d characters", len(chars), total)
+
+    # Conversations are fetched on demand from /api/chats, the page itself is only the shell
+    body = render_template("index.html", characters=chars)
+    _index_page = (version, body, hashlib.sha1(body.encode("utf-8")).hexdigest()[:20])
+    return _index_page
+
+def conditional(response):
+    """Let the browser revalidate on every load and answer unchanged content with a 304"""
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @app.route("/")
 def index():
+    _, body, etag = render_index_page()
+    response = make_response(body)
+    response.set_etag(etag)
+
     # Generate a simple user ID (in production, use proper user authentication)
+    if not request.cookies.get('user_id'):
+        response.set_cookie('user_id', str(uuid.uuid4()), max_age=31536000)  # 1 year expiry
+    return conditional(response)
+
+PUBLIC_CHARACTER_FIELDS = ("name", "slug", "traits", "style", "universe", "alias", "greeting")
+
+def public_character(char):
+    return {**{field: char.get(field) for field in PUBLIC_CHARACTER_FIELDS},
+            "avatar": url_for('avatar', character=char['slug'])}
+
+@app.route("/api/characters")
+def list_characters():
+    """Search the roster by name, alias, universe or traits, paginated with limit/offset"""
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    total, page = character_registry.search(request.args.get('q', ''), limit=limit, offset=offset)
+    return jsonify({
+        "total": total,
+        "offset": offset,
+        "characters": [public_character(c) for c in page]
+    })
+
+@app.route("/api/characters/<name>")
+def get_character(name):
+    char = character_registry.get(name)
+    if not char:
+        return jsonify({'error': 'Character not found'}), 404
+    return jsonify(public_character(char))
+
+# Strip control characters (keeping newlines and tabs) before content reaches the browser
+CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b-\x1f\x7f-\x9f]")
+PREVIEW_CHARS = 80
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX = 200
+
+def clean_content(text):
+    return CONTROL_CHARS.sub("", text).strip()
+
+def has_content(msg):
+    content = msg.get('content')
+    return isinstance(content, str) and bool(content.strip())
+
+def summarize_chats(history):
+    """Group history into chat summaries (id, character, lastActivity, preview), newest first"""
+    chats = {}
+    for msg in history:
+        chat_id = msg.get('chatId')
+        if not chat_id or not has_content(msg):
+            continue
+        chat = chats.get(chat_id)
+        if chat is None:
+            chat = chats[chat_id] = {'id': chat_id, 'character': None, 'lastActivity': 0.0, 'preview': '', 'messageCount': 0}
+        if not chat['character'] and msg.get('character') not in (None, '', 'Unknown'):
+            chat['character'] = msg['character']
+        chat['lastActivity'] = max(chat['lastActivity'], float(msg.get('timestamp', 0)))
+        chat['preview'] = msg['content']
+        chat['messageCount'] += 1
+
+    default = character_registry.default()
+    default_character = default['name'] if default else 'Unknown'
+    for chat in chats.values():
+        chat['character'] = chat['character'] or default_character
+        chat['preview'] = clean_content(chat['preview'])[:PREVIEW_CHARS]
+    return sorted(chats.values(), key=lambda c: c['lastActivity'], reverse=True)
+
+def clean_message(msg, chat_id):
+    role = msg.get('type', msg.get('role', 'user'))
+    return {
+        'chatId': chat_id,
+        'content': clean_content(msg['content']),
+        'type': 'ai' if role in ('assistant', 'ai') else 'user',
+        'character': msg.get('character'),
+        'timestamp': float(msg.get('timestamp', 0))
+    }
+
+@app.route("/api/chats")
+def list_chats():
+    """Chat list for the sidebar, without message bodies"""
     user_id = request.cookies.get('user_id')
-    if not user_id:
-        user_id = str(uuid.uuid4())
-    
-    print(f"Handling request for user: {user_id}")
-    
-    # Prepare characters
-    chars = []
+    history = load_chat_history(user_id) if S3_BUCKET and user_id else []
+    response = jsonify({"chats": summarize_chats(history)})
+    response.add_etag()
+    return conditional(response)
+
+@app.route("/api/chats/<chat_id>/messages")
+def chat_messages(chat_id):
+    """One page of a chat's messages, oldest first.
+
+    Pass the returned ``nextCursor`` as ``before`` to fetch the page of older messages.
+    """
+    user_id = request.cookies.get('user_id')
+    limit = min(max(request.args.get('limit', MESSAGES_PAGE_SIZE, type=int), 1), MESSAGES_PAGE_MAX)
+    before = request.args.get('before', type=float)
+
+    history = load_chat_history(user_id) if S3_BUCKET and user_id else []
+    matching = [
+        msg for msg in history
+        if msg.get('chatId') == chat_id and has_content(msg)
+        and (before is None or float(msg.get('timestamp', 0)) < before)
+    ]
+    page = [clean_message(msg, chat_id) for msg in matching[-limit:]]
+    return jsonify({
+        "chatId": chat_id,
+        "messages": page,
+        "nextCursor": page[0]['timestamp'] if len(matching) > limit else None
+    })
+
+# Reuses replies to repeated openers (off unless REPLY_CACHE_ENABLED=true)
+reply_cache = ReplyCache()
+
+# Packs recent turns of the current chat into the prompt, folding older ones into a summary
+context_builder = ContextBuilder()
+
+def build_system_prompt(char):
+    return char['system_prompt']
+
+def build_payload(char, user_msg, history=(), chat_id='default', user_id=None, stream=False):
+    messages = context_builder.build(
+        build_system_prompt(char), history, chat_id, user_msg,
+        user_id=user_id, character=char['name']
+    )
+    payload = {
+        "model": CHARACTER_MODEL,
+        "messages": messages,
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "max_tokens": 500
+    }
+    if stream:
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}  # final chunk carries token usage
+    return payload
+
+def reply_cache_key(data, char, payload):
+    """Reply cache key for this request, or None if the cache is off or the client opted out"""
+    if not reply_cache.enabled or data.get("cache") is False:
+        return None
+    # Everything except the final user message is the context the reply depends on
+    return reply_cache.key(char['name'], CHARACTER_MODEL, data.get("message", ""), payload["messages"][:-1])
+
+# Per-user token bucket; the global upstream concurrency cap lives in the upstream client
+user_limiter = UserRateLimiter()
+
+# Duplicate submissions (double clicks, client retries) share the first one's reply
+single_flight = SingleFlight()
+
+def join_flight(user_id, chat_id, char, user_msg):
+    """(flight key, flight, replayed reply) for a chat submission, see idempotency.py"""
+    key, fingerprint = single_flight.key(user_id or request.remote_addr, chat_id, char['name'], user_msg,
+                                         request.headers.get('Idempotency-Key'))
+    flight, replayed = single_flight.join(key, fingerprint)
+    return key, flight, replayed
+THROTTLED_STATUSES = (429, 503)
+
+# Pool of upstream endpoints (LLM_ENDPOINTS), defaulting to CHUTES_BASE_URL / CHARACTER_MODEL
+llm_router = LLMRouter.from_env(upstream, CHUTES_BASE_URL, CHARACTER_MODEL, CHUTES_API_KEY)
+metrics.register_collector(llm_router.collect)
+
+def upstream_error_reply(resp):
+    """Turn a non-200 upstream response into the reply text shown to the user"""
+    if resp.status_code == 429:  # rate limit
+        return "Too many requests. Please try again later."
     try:
-        for c in characters:
-            avatar_url = fetch_avatar_url(c["avatar"]) if S3_BUCKET else None
-            chars.append({**c, "avatar_url": avatar_url})
-        print(f"Prepared {len(chars)} characters")
-    except Exception as e:
-        print(f"Error preparing characters: {e}")
-        chars = []
-    
-    # Load chat history
-    chat_history = []
+        error_msg = resp.json().get("error", {}).get("message", f"Error {resp.status_code}")
+    except Exception:
+        error_msg = f"Error: {resp.status_code}"
+    return f"Sorry, there was an error: {error_msg}"
+
+def demo_reply(char):
+    return f"As {char['name']}: {random.choice(['Believe it!', 'Lets train harder!', 'You can do it!'])}"
+
+def persist_turn(user_id, chat_id, user_msg, reply, char_name):
+    """Append a user/assistant exchange to the user's stored history, returning the new messages"""
+    return persist_group_turn(user_id, chat_id, user_msg, [(char_name, reply)])
+
+def persist_group_turn(user_id, chat_id, user_msg, replies):
+    """Append a user message and the (character, reply) pairs answering it in a single write
+
+    Returns the appended messages (also when there is nowhere to store them).
+    """
+    messages = [
+        {
+            "role": "user",
+            "content": user_msg,
+            "timestamp": time.time(),
+            "chatId": chat_id
+        }
+    ] + [
+        {
+            "role": "assistant",
+            "content": reply,
+            "character": char_name,
+            "timestamp": time.time(),
+            "chatId": chat_id
+        }
+        for char_name, reply in replies
+    ]
+    if S3_BUCKET and user_id:
+        append_chat_history(user_id, messages)
+    return messages
+
+def admission_error_response(e):
+    """429/503 JSON response for a request turned away before reaching the upstream"""
+    response = jsonify({"error": str(e), "reply": str(e)})
+    response.status_code = e.status_code
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+def upstream_throttled_response(resp):
+    """Pass an upstream 429/503 that outlasted our retries on to the client"""
+    message = upstream_error_reply(resp)
+    response = jsonify({"error": message, "reply": message})
+    response.status_code = resp.status_code
+    retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+    if retry_after is not None:
+        response.headers["Retry-After"] = str(math.ceil(retry_after))
+    return response
+
+def complete_reply(payload, cache_key=None):
+    """Non-streamed reply for a payload, as (reply, None) or (None, upstream response) if throttled
+
+    Raises ``AdmissionError`` when no upstream slot is free and
+    ``requests.exceptions.RequestException`` on network errors.
+    """
+    reply = reply_cache.get(cache_key) if cache_key else None
+    if reply is not None:
+        return reply, None
+    with closing(llm_router.open(payload)) as call:
+        resp = call.resp
+        if resp.status_code in THROTTLED_STATUSES:
+            return None, resp
+        if resp.status_code != 200:
+            return upstream_error_reply(resp), None
+        resp_json = resp.json()
+        reply = resp_json["choices"][0]["message"]["content"]
+        metrics.record_usage(resp_json.get("usage"))
+        if cache_key:
+            reply_cache.put(cache_key, reply)
+        return reply, None
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    data = request.get_json()
+    user_msg = data.get("message", "")
+    char_name = data.get("character", "Naruto")
+    char = character_registry.resolve(char_name)
+    user_id = request.cookies.get('user_id')
+    chat_id = data.get('chatId', 'default')
+
     try:
-        if S3_BUCKET:
-            chat_history = load_chat_history(user_id)
-            print(f"Loaded {len(chat_history)} messages from history")
-            
-            # Clean message content of any control characters
-            for msg in chat_history:
-                if 'content' in msg and isinstance(msg['content'], str):
-                    msg['content'] = ''.join(char for char in msg['content'] 
-                                           if char.isprintable() or char in ['\n', '\t'])
-        else:
-            print("S3 bucket not configured, skipping chat history load")
-    except Exception as e:
-        print(f"Error loading chat history: {e}")
-        chat_history = []
-    
-    # Group chat history
-    grouped_history = {}
+        flight_key, flight, replayed = join_flight(user_id, chat_id, char, user_msg)
+    except IdempotencyMismatch as e:
+        return jsonify({"error": str(e)}), 422
+    if replayed is not None:
+        response = jsonify({"reply": replayed})
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+    # Every path that returns before the turn is stored leaves duplicates to answer themselves
     try:
-        for msg in chat_history:
-            chat_id = msg.get('chatId')
-            if not chat_id:  # Skip messages without chat ID
-                continue
-                
-            if chat_id not in grouped_history:
-                # Find the character for this chat
-                character = msg.get('character')
-                if not character or character == 'Unknown':
-                    character = next((c['name'] for c in chars if c['name']), chars[0]['name'] if chars else 'Unknown')
-                
-                print(f"Creating new chat group: {chat_id} with character: {character}")
-                grouped_history[chat_id] = {
-                    'id': chat_id,
-                    'character': character,
-                    'messages': [],
-                    'lastActivity': float(msg.get('timestamp', time.time()))
-                }
-            
-            # Add message to chat
-            grouped_history[chat_id]['messages'].append(msg)
-            
-            # Update lastActivity
-            msg_time = float(msg.get('timestamp', time.time()))
-            grouped_history[chat_id]['lastActivity'] = max(
-                grouped_history[chat_id]['lastActivity'],
-                msg_time
-            )
-        
-        print(f"Grouped messages into {len(grouped_history)} chats")
-    except Exception as e:
-        print(f"Error grouping chat history: {e}")
-        grouped_history = {}
-            
-        grouped_history[chat_id]['messages'].append(msg)
-        grouped_history[chat_id]['lastActivity'] = max(
-            grouped_history[chat_id]['lastActivity'], 
-            msg.get('timestamp', time.time())
-        )
+        try:
+            user_limiter.check(user_id or request.remote_addr)
+        except AdmissionError as e:
+            return admission_error_response(e)
+
+        if DEMO_MODE:
+            reply = demo_reply(char)
+
+        else:
+            # Earlier turns of this chat give the character its memory
+            chat_history = load_chat_history(user_id) if S3_BUCKET and user_id else []
+            payload = build_payload(char, user_msg, chat_history, chat_id, user_id)
+            try:
+                reply, throttled = complete_reply(payload, reply_cache_key(data, char, payload))
+                if throttled is not None:
+                    return upstream_throttled_response(throttled)
+            except AdmissionError as e:
+                return admission_error_response(e)
+            except requests.exceptions.RequestException:
+                reply = "Network error. Please try again."
+
+        # Add to chat history
+        persist_turn(user_id, chat_id, user_msg, reply, char_name)
+        single_flight.finish(flight_key, flight, reply)
+    finally:
+        single_flight.fail(flight_key, flight)
+
+    return jsonify({"reply": reply})
+
+# Group chat: one message answered by several characters, fetched concurrently
+GROUP_CHAT_MAX_CHARACTERS = int(os.getenv("GROUP_CHAT_MAX_CHARACTERS", "5"))
+GROUP_CHAT_CONCURRENCY = int(os.getenv("GROUP_CHAT_CONCURRENCY", "3"))  # upstream calls per request
+
+@app.route("/chat/group", methods=["POST"])
+def chat_group():
+    """Send one message to several characters, streaming each reply (SSE) as soon as it is complete
+
+    Takes ``{"message", "characters": [names], "chatId"}``. Every character gets
+    a ``reply`` event as it finishes; the closing ``done`` event lists all
+    replies in the requested order, after the turn was stored in one write.
+    """
+    data = request.get_json()
+    user_msg = data.get("message", "")
+    names = data.get("characters")
+    user_id = request.cookies.get('user_id')
+    chat_id = data.get('chatId', 'default')
+
+    if not isinstance(names, list) or not names:
+        return jsonify({'error': 'characters must be a non-empty list'}), 400
+    chars = []
+    for name in names:
+        char = character_registry.get(name) if isinstance(name, str) else None
+        if not char:
+            return jsonify({'error': f'Unknown character: {name}'}), 400
+        if char not in chars:
+            chars.append(char)
+    if len(chars) > GROUP_CHAT_MAX_CHARACTERS:
+        return jsonify({'error': f'At most {GROUP_CHAT_MAX_CHARACTERS} characters per group message'}), 400
 
-    # Clean and encode the grouped history for the template
-    clean_history = {}
     try:
-        for chat_id, chat in grouped_history.items():
-            clean_chat = {
-                'id': chat_id,
-                'character': chat.get('character', 'Unknown'),
-                'messages': [],
-                'lastActivity': chat.get('lastActivity', time.time())
-            }
-            
-            # Clean and validate each message
-            for msg in chat.get('messages', []):
-                clean_msg = {
-                    'chatId': chat_id,
-                    'content': msg.get('content', '').strip(),
-                    'type': msg.get('type', msg.get('role', 'user')),
-                    'character': msg.get('character', chat.get('character', 'Unknown')),
-                    'timestamp': msg.get('timestamp', time.time())
-                }
-                if clean_msg['content']:  # Only add non-empty messages
-                    clean_chat['messages'].append(clean_msg)
-            
-            if clean_chat['messages']:  # Only add chats with messages
-                clean_history[chat_id] = clean_chat
-        
-        print(f"Prepared {len(clean_history)} clean chats for template")
-    except Exception as e:
-        print(f"Error cleaning chat history: {e}")
-        clean_history = {}
-    
-    # Pass clean_history instead of grouped_history
-    response = make_response(render_template(
-        "index.html",
-        characters=chars,
-        chat_history=clean_history
-    ))
+        user_limiter.check(user_id or request.remote_addr)
+    except AdmissionError as e:
+        return admission_error_response(e)
 
-    if not request.cookies.get('user_id'):
-        response.set_cookie('user_id', user_id, max_age=31536000)  # 1 year expiry
+    # Every character sees the same history, so it is read once for all of them
+    chat_history = load_chat_history(user_id) if S3_BUCKET and user_id and not DEMO_MODE else []
+
+    def reply_for(char):
+        if DEMO_MODE:
+            return demo_reply(char)
+        payload = build_payload(char, user_msg, chat_history, chat_id, user_id)
+        try:
+            reply, throttled = complete_reply(payload, reply_cache_key(data, char, payload))
+            return upstream_error_reply(throttled) if throttled is not None else reply
+        except AdmissionError as e:
+            return str(e)
+        except requests.exceptions.RequestException:
+            return "Network error. Please try again."
+
+    def generate():
+        replies = {}
+        pool = ThreadPoolExecutor(max_workers=min(GROUP_CHAT_CONCURRENCY, len(chars)),
+                                  thread_name_prefix="group-chat")
+        try:
+            futures = {pool.submit(reply_for, char): char for char in chars}
+            for future in as_completed(futures):
+                name = futures[future]['name']
+                replies[name] = future.result()
+                yield sse_event({"character": name, "reply": replies[name]}, event="reply")
+        finally:
+            # Nothing left to wait for if the client went away halfway
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        ordered = [(char['name'], replies[char['name']]) for char in chars]
+        persist_group_turn(user_id, chat_id, user_msg, ordered)
+        yield sse_event({"replies": [{"character": name, "reply": reply} for name, reply in ordered]},
+                        event="done")
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # disable Nginx proxy buffering
     return response
 
-@app.route("/chat", methods=["POST"])
-def chat():
+def sse_event(data, event=None):
+    """Format a single Server-Sent Event frame"""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """Stream the reply as Server-Sent Events, then persist the assembled turn"""
     data = request.get_json()
     user_msg = data.get("message", "")
     char_name = data.get("character", "Naruto")
-    char = next((c for c in characters if c["name"] == char_name), characters[0])
+    char = character_registry.resolve(char_name)
     user_id = request.cookies.get('user_id')
+    chat_id = data.get('chatId', 'default')
 
-    # Load existing chat history
-    chat_history = load_chat_history(user_id) if S3_BUCKET and user_id else []
-    
-    if DEMO_MODE:
-        reply = f"As {char['name']}: {random.choice(['Believe it!', 'Lets train harder!', 'You can do it!'])}"
-        
-    else:
-        # System prompt
-        system_prompt = f"""You are {char['name']}. You possess the following traits: {char['traits']}
-        Your communication style is: {char['style']}
-        Respond naturally, staying in character at all times.
-        """
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_msg}
-        ]
-
-        headers = {
-            "Authorization": f"Bearer {CHUTES_API_KEY}",
-            "Content-Type": "application/json"
-        }
+    try:
+        flight_key, flight, replayed = join_flight(user_id, chat_id, char, user_msg)
+    except IdempotencyMismatch as e:
+        return jsonify({"error": str(e)}), 422
+    if replayed is not None:
+        response = Response(sse_event({"delta": replayed}) + sse_event({"reply": replayed}, event="done"),
+                            mimetype="text/event-stream")
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
 
-        payload = {
-            "model": CHARACTER_MODEL,
-            "messages": messages,
-            "temperature": 0.7,
-            "top_p": 0.9,
-            "max_tokens": 500
-        }
+    # Duplicates are left to answer themselves if this returns before streaming
+    streaming = False
+    try:
+        try:
+            user_limiter.check(user_id or request.remote_addr)
+        except AdmissionError as e:
+            return admission_error_response(e)
+
+        # The upstream call is opened before the response starts, so a full queue or
+        # a throttled upstream still gets a real 429/503 instead of a 200 stream
+        upstream_call = ExitStack()
+        call = resp = cached = cache_key = None
+        network_error = False
+        if not DEMO_MODE:
+            chat_history = load_chat_history(user_id) if S3_BUCKET and user_id else []
+            payload = build_payload(char, user_msg, chat_history, chat_id, user_id, stream=True)
+            cache_key = reply_cache_key(data, char, payload)
+            cached = reply_cache.get(cache_key) if cache_key else None
+            if cached is None:
+                try:
+                    # Returns once the first token arrived, failing over or hedging across endpoints
+                    call = upstream_call.enter_context(closing(llm_router.open(payload, stream=True)))
+                    resp = call.resp
+                except AdmissionError as e:
+                    return admission_error_response(e)
+                except requests.exceptions.RequestException:
+                    network_error = True
+                if resp is not None and resp.status_code in THROTTLED_STATUSES:
+                    response = upstream_throttled_response(resp)
+                    upstream_call.close()
+                    return response
+        streaming = True
+    finally:
+        if not streaming:
+            single_flight.fail(flight_key, flight)
+
+    def generate():
+        parts = []
+        if DEMO_MODE:
+            for word in demo_reply(char).split(" "):
+                delta = word if not parts else " " + word
+                parts.append(delta)
+                yield sse_event({"delta": delta})
+        elif cached is not None:
+            parts.append(cached)
+            yield sse_event({"delta": cached})
+        elif network_error:
+            parts = ["Network error. Please try again."]
+            yield sse_event({"delta": parts[0]})
+        elif resp.status_code == 200:
+            try:
+                for delta in call.deltas():
+                    parts.append(delta)
+                    yield sse_event({"delta": delta})
+                if cache_key and parts:
+                    reply_cache.put(cache_key, "".join(parts))
+            except requests.exceptions.RequestException:
+                # Keep whatever already reached the client, otherwise report the failure
+                if not parts:
+                    parts = ["Network error. Please try again."]
+                    yield sse_event({"delta": parts[0]})
+        else:
+            parts = [upstream_error_reply(resp)]
+            yield sse_event({"delta": parts[0]})
+        # Free the upstream slot before the history write
+        upstream_call.close()
+
+        reply = "".join(parts)
+        # History is written only once the stream ends so it never delays the first token
+        persist_turn(user_id, chat_id, user_msg, reply, char_name)
+        single_flight.finish(flight_key, flight, reply)
+        yield sse_event({"reply": reply}, event="done")
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # disable Nginx proxy buffering
+    # Also releases the upstream call if the client goes away before the stream ends
+    response.call_on_close(upstream_call.close)
+    response.call_on_close(lambda: single_flight.fail(flight_key, flight))
+    return response
+
+
+# Persistent chat channel: one WebSocket per browser tab, see ws_session.py
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "25"))  # server pings keep proxies from closing idle sockets
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "90"))  # seconds without a client frame before closing
+ws_sessions = SessionRegistry()
+
+def ws_error(session, msg_id, message, retry_after=None):
+    session.emit({"type": "error", "id": msg_id, "error": message, "retry_after": retry_after})
+
+def ws_turn(session, client, data, msg_id, chat_id, char):
+    """Answer one message of a session, emitting delta/done/history events
+
+    Runs on its own thread so the connection keeps answering pings, and so the
+    reply keeps streaming into the session's replay buffer if the tab drops.
+    The client's message id doubles as the idempotency key, so a message sent
+    again after a reconnect is answered once.
+    """
+    user_msg = data["message"]
+    with session.turn_lock:
+        key, fingerprint = single_flight.key(client, chat_id, char['name'], user_msg, msg_id)
+        try:
+            flight, replayed = single_flight.join(key, fingerprint)
+        except IdempotencyMismatch as e:
+            return ws_error(session, msg_id, str(e))
+        if replayed is not None:
+            return session.emit({"type": "done", "id": msg_id, "reply": replayed, "replayed": True})
 
         try:
-            resp = requests.post(CHUTES_BASE_URL, headers=headers, json=payload, timeout=30)
-
-            if resp.status_code == 200:
-                resp_json = resp.json()
-                reply = resp_json["choices"][0]["message"]["content"]
-            
-            elif resp.status_code == 429:  # rate limit
-                reply = "Too many requests. Please try again later."
-            
+            try:
+                user_limiter.check(client)
+            except AdmissionError as e:
+                return ws_error(session, msg_id, str(e), e.retry_after)
+
+            parts = []
+            def push(delta):
+                parts.append(delta)
+                session.emit({"type": "delta", "id": msg_id, "delta": delta})
+
+            if DEMO_MODE:
+                for word in demo_reply(char).split(" "):
+                    push(word if not parts else " " + word)
             else:
-                try:
-                    error_msg = resp.json().get("error", {}).get("message", f"Error {resp.status_code}")
-                except:
-                    error_msg = f"Error: {resp.status_code}"
-                reply = f"Sorry, there was an error: {error_msg}"
+                # The session's resident history stands in for the per-message S3 read
+                payload = build_payload(char, user_msg, session.history, chat_id, session.user_id, stream=True)
+                cache_key = reply_cache_key(data, char, payload)
+                cached = reply_cache.get(cache_key) if cache_key else None
+                if cached is not None:
+                    push(cached)
+                else:
+                    try:
+                        with closing(llm_router.open(payload, stream=True)) as call:
+                            resp = call.resp
+                            if resp.status_code in THROTTLED_STATUSES:
+                                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                                return ws_error(session, msg_id, upstream_error_reply(resp),
+                                                math.ceil(retry_after) if retry_after is not None else None)
+                            if resp.status_code != 200:
+                                push(upstream_error_reply(resp))
+                            else:
+                                for delta in call.deltas():
+                                    push(delta)
+                                if cache_key and parts:
+                                    reply_cache.put(cache_key, "".join(parts))
+                    except AdmissionError as e:
+                        return ws_error(session, msg_id, str(e), e.retry_after)
+                    except requests.exceptions.RequestException:
+                        if not parts:
+                            push("Network error. Please try again.")
 
-        except requests.exceptions.RequestException:
-            reply = "Network error. Please try again."
-    
-    # Add to chat history
-    if S3_BUCKET and user_id:
-        chat_history.append({
-            "role": "user",
-            "content": user_msg,
-            "timestamp": time.time(),
-            "chatId": data.get('chatId', 'default')
+            reply = "".join(parts)
+            messages = persist_turn(session.user_id, chat_id, user_msg, reply, char['name'])
+            single_flight.finish(key, flight, reply)
+            session.emit({"type": "done", "id": msg_id, "reply": reply})
+        finally:
+            single_flight.fail(key, flight)
 
-        })
-        chat_history.append({
-            "role": "assistant",
-            "content": reply,
-            "character": char_name,
-            "timestamp": time.time(),
-            "chatId": data.get('chatId', 'default')
-        })
-        # Keep only last 50 messages
-        if len(chat_history) > 50:
-            chat_history = chat_history[-50:]
-        save_chat_history(user_id, chat_history)
-    
-    return jsonify({"reply": reply})
+    # Every tab of the user in this worker gets the new messages (and keeps them for its next prompt)
+    update = {"type": "history", "id": msg_id, "chatId": chat_id, "messages": [clean_message(m, chat_id) for m in messages]}
+    for other in (ws_sessions.user_sessions(session.user_id) if session.user_id else [session]):
+        other.history.extend(messages)
+        del other.history[:-history_store.max_messages]
+        other.emit(update)
+
+def ws_frame(raw):
+    try:
+        frame = json.loads(raw)
+    except (TypeError, ValueError):
+        return None
+    return frame if isinstance(frame, dict) else None
+
+def chat_socket(ws):
+    """Chat over one WebSocket per tab instead of a POST per message
 
+    The client opens with ``{"type": "hello", "session", "lastSeq", "character"}``
+    (session and lastSeq only when reconnecting) and gets the missed events
+    followed by ``{"type": "ready", "session", "resumed", "complete", "seq"}``;
+    without ``resumed`` and ``complete`` it should reload the chat over HTTP.
+    It then sends ``message`` (``{"id", "message", "chatId", "character"}``),
+    ``character`` (``{"character"}``) and ``ping`` frames, and receives
+    ``delta``, ``done``, ``error`` and ``history`` events, each with a ``seq``,
+    plus a ``pong`` for every ping.
+    """
+    user_id = request.cookies.get('user_id')
+    client = user_id or request.remote_addr
+    hello = ws_frame(ws.receive(timeout=WS_IDLE_TIMEOUT))
+    if not hello or hello.get("type") != "hello":
+        ws.close(reason=1008, message="Expected a hello frame")
+        return
+
+    def load_session():
+        char = character_registry.resolve(hello.get("character") or "Naruto")
+        history = load_chat_history(user_id) if S3_BUCKET and user_id else []
+        return ChatSession(user_id, history, char)
+
+    session, resumed = ws_sessions.open(user_id, hello.get("session"), load_session)
+    last_seq = hello.get("lastSeq")
+    try:
+        # Inside the try: a send failing during the replay must still detach the socket
+        complete = session.attach(ws, last_seq if resumed and isinstance(last_seq, int) else None)
+        session.send_unbuffered({"type": "ready", "session": session.id, "resumed": resumed,
+                                 "complete": complete, "seq": session.seq,
+                                 "character": session.character['name']})
+        while True:
+            raw = ws.receive(timeout=WS_IDLE_TIMEOUT)
+            if raw is None:  # idle: no heartbeat from the client
+                break
+            frame = ws_frame(raw)
+            kind = frame.get("type") if frame else None
+            if kind == "ping":
+                session.send_unbuffered({"type": "pong"})
+            elif kind == "character":
+                session.character = character_registry.resolve(frame.get("character")) or session.character
+            elif kind == "message":
+                msg_id = str(frame.get("id") or uuid.uuid4().hex)
+                if not isinstance(frame.get("message"), str) or not frame["message"].strip():
+                    ws_error(session, msg_id, "message must be a non-empty string")
+                    continue
+                if frame.get("character"):
+                    session.character = character_registry.resolve(frame["character"]) or session.character
+                threading.Thread(target=ws_turn, name="ws-turn", daemon=True,
+                                 args=(session, client, frame, msg_id, frame.get("chatId") or 'default',
+                                       session.character)).start()
+    except ConnectionClosed:
+        pass
+    finally:
+        session.detach(ws)
+
+if Sock is not None:
+    app.config["SOCK_SERVER_OPTIONS"] = {"ping_interval": WS_PING_INTERVAL, "max_message_size": 64 * 1024}
+    Sock(app).route("/ws/chat")(chat_socket)
+else:
+    log.warning("flask-sock is not installed, the WebSocket chat channel (/ws/chat) is disabled")
+
+# Dependencies are probed in the background; the endpoints below only read the latest results
+HEALTH_S3_CONFIG_INTERVAL = float(os.getenv("HEALTH_S3_CONFIG_INTERVAL", "300"))
+HEALTH_S3_KEY = os.getenv("HEALTH_S3_KEY", "health/probe")
+health_monitor = HealthMonitor()
+
+def check_s3_bucket():
+    """HEAD a probe object, writing it first if needed
+
+    Needs only the s3:GetObject / s3:PutObject the app itself uses (head_bucket
+    would also need s3:ListBucket).
+    """
+    s3_client = get_s3_client()
+    try:
+        s3_client.head_object(Bucket=S3_BUCKET, Key=HEALTH_S3_KEY)
+    except ClientError as e:
+        # Without s3:ListBucket a missing object is a 403 rather than a 404
+        if e.response['Error'].get('Code', '') not in ("404", "NoSuchKey", "403", "AccessDenied"):
+            raise
+        s3_client.put_object(Bucket=S3_BUCKET, Key=HEALTH_S3_KEY, Body=b"ok", ContentType="text/plain")
+        s3_client.head_object(Bucket=S3_BUCKET, Key=HEALTH_S3_KEY)
+    return {"key": HEALTH_S3_KEY}
+
+def config_status(fetch):
+    """(configured, error) for an optional bucket setting such as CORS rules"""
+    try:
+        fetch(Bucket=S3_BUCKET)
+        return True, None
+    except ClientError as e:
+        return False, str(e)
+
+def check_s3_config():
+    """Bucket CORS / policy and a sample of stored keys, for the S3 diagnostics endpoints"""
+    s3_client = get_s3_client()
+    cors_configured, cors_error = config_status(s3_client.get_bucket_cors)
+    has_policy, policy_error = config_status(s3_client.get_bucket_policy)
+    listings = {}
+    for name, prefix in (("character_images", "character_images/"), ("chat_histories", "chat_history/")):
+        response = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix, MaxKeys=10)
+        listings[name] = [obj['Key'] for obj in response.get('Contents', [])]
+    return {
+        "cors_configured": cors_configured,
+        "cors_error": cors_error,
+        "has_policy": has_policy,
+        "policy_error": policy_error,
+        **listings
+    }
+
+def llm_endpoint_check(endpoint):
+    """Reachability of an endpoint's model list (no tokens are generated)"""
+    models_url = re.sub(r"/chat/completions/?$", "/models", endpoint.url)
+
+    def check():
+        resp = upstream.session.get(models_url, headers=endpoint.headers(), timeout=upstream.timeout)
+        resp.close()
+        if resp.status_code >= 500 or resp.status_code in (401, 403):
+            raise RuntimeError(f"HTTP {resp.status_code} from {models_url}")
+        return {"status_code": resp.status_code}
+    return check
+
+if S3_BUCKET:
+    health_monitor.add_check("s3", check_s3_bucket)
+    health_monitor.add_check("s3_config", check_s3_config, interval=HEALTH_S3_CONFIG_INTERVAL, critical=False)
+if not DEMO_MODE:
+    # Chat degrades to errors without the LLM but the rest of the app still works
+    for endpoint in llm_router.endpoints:
+        health_monitor.add_check(f"llm:{endpoint.name}", llm_endpoint_check(endpoint), critical=False)
+metrics.register_collector(health_monitor.collect)
 
 @app.route("/health")
+@app.route("/livez")
 def health():
+    """Liveness: the worker is up and serving requests"""
     return "OK", 200
 
+@app.route("/readyz")
+def readyz():
+    """Readiness from the latest background checks, never calls S3 or the LLM itself"""
+    snapshot = health_monitor.snapshot()
+    return jsonify(snapshot), 200 if snapshot["ready"] else 503
+
+def cache_gauges():
+    """Expose the /stats cache counters as gauges on /metrics"""
+    gauges = []
+    for cache_name, cache_stats in (("history_cache", history_cache.stats()),
+                                    ("url_cache", url_cache.stats()),
+                                    ("avatar_cache", avatar_cache.stats()),
+                                    ("reply_cache", reply_cache.stats()),
+                                    ("single_flight", single_flight.stats()),
+                                    ("ws", ws_sessions.stats()),
+                                    ("upstream", upstream.limiter.stats())):
+        for field, value in cache_stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges.append((f"{cache_name}_{field}", f"{cache_name} {field} (see /stats)", {(): value}))
+    return gauges
+
+metrics.register_collector(cache_gauges)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape endpoint (per worker)"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route("/stats")
+def stats():
+    """Per-worker cache statistics"""
+    return jsonify({
+        "history_cache": history_cache.stats(),
+        "url_cache": url_cache.stats(),
+        "avatar_cache": avatar_cache.stats(),
+        "reply_cache": reply_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "ws": ws_sessions.stats(),
+        "upstream": upstream.limiter.stats(),
+        "llm_endpoints": llm_router.stats()
+    })
+
+def s3_check_results():
+    """(bucket check, config check) results, or an error response if S3 is not known to be reachable"""
+    bucket, config = health_monitor.result("s3"), health_monitor.result("s3_config")
+    if bucket is None:
+        return None, jsonify({"status": "error", "message": "S3 not configured", "bucket": S3_BUCKET})
+    if bucket["ok"] is None or config["ok"] is None:
+        return None, (jsonify({"status": "pending", "message": "S3 has not been checked yet",
+                               "bucket": S3_BUCKET}), 503)
+    if not bucket["ok"] or not config["ok"]:
+        failed = bucket if not bucket["ok"] else config
+        return None, (jsonify({"status": "error", "message": failed["last_error"], "bucket": S3_BUCKET,
+                               "region": AWS_REGION, "checked_at": failed["checked_at"]}), 500)
+    return (bucket, config), None
+
 @app.route("/check_s3")
 def check_s3():
-    """Check S3 configuration and test image access"""
-    try:
-        # Test bucket access
-        s3_client.head_bucket(Bucket=S3_BUCKET)
-        
-        # Check CORS configuration
-        try:
-            cors = s3_client.get_bucket_cors(Bucket=S3_BUCKET)
-            cors_status = "Configured"
-        except ClientError as e:
-            cors_status = f"Not configured: {str(e)}"
-        
-        # Check bucket policy
-        try:
-            policy = s3_client.get_bucket_policy(Bucket=S3_BUCKET)
-            policy_status = "Configured"
-        except ClientError as e:
-            policy_status = f"Not configured: {str(e)}"
-        
-        # Test character image access
-        test_images = ['naruto.jpg', 'iron_man.jpg']
-        image_status = {}
-        
-        for img in test_images:
-            try:
-                key = f"character_images/{img}"
-                url = s3_client.generate_presigned_url(
-                    'get_object',
-                    Params={'Bucket': S3_BUCKET, 'Key': key},
-                    ExpiresIn=3600
-                )
-                image_status[img] = {
-                    "status": "Available",
-                    "url": url
-                }
-            except Exception as e:
-                image_status[img] = {
-                    "status": "Error",
-                    "error": str(e)
-                }
-        
-        return jsonify({
-            "status": "success",
-            "bucket": S3_BUCKET,
-            "region": os.getenv('AWS_REGION', 'ap-southeast-2'),
-            "cors_status": cors_status,
-            "policy_status": policy_status,
-            "images": image_status
-        })
-        
-    except Exception as e:
-        return jsonify({
-            "status": "error",
-            "message": str(e),
-            "bucket": S3_BUCKET
-        }), 500
+    """S3 configuration and test image URLs, from the latest background check"""
+    results, error = s3_check_results()
+    if error:
+        return error
+    bucket, config = results
+    details = config["details"]
+    s3_client = get_s3_client()
+
+    # Presigning is local, it makes no request to S3
+    image_status = {}
+    for img in ['naruto.jpg', 'iron_man.jpg']:
+        url = s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': S3_BUCKET, 'Key': f"character_images/{img}"},
+            ExpiresIn=3600
+        )
+        image_status[img] = {"status": "Available", "url": url}
+
+    return jsonify({
+        "status": "success",
+        "bucket": S3_BUCKET,
+        "region": AWS_REGION,
+        "cors_status": "Configured" if details["cors_configured"] else f"Not configured: {details['cors_error']}",
+        "policy_status": "Configured" if details["has_policy"] else f"Not configured: {details['policy_error']}",
+        "images": image_status,
+        "checked_at": bucket["checked_at"],
+        "latency_ms": bucket["latency_ms"]
+    })
 
 @app.route("/check_s3_config")
-def check_s3_config():
-    """Check S3 configuration and permissions"""
-    if not s3_client or not S3_BUCKET:
-        return jsonify({
-            "status": "error",
-            "message": "S3 not configured",
-            "bucket": S3_BUCKET,
-            "client": bool(s3_client)
-        })
-    
-    try:
-        # Check if bucket exists and is accessible
-        s3_client.head_bucket(Bucket=S3_BUCKET)
-        
-        # Try to get bucket CORS configuration
-        try:
-            cors = s3_client.get_bucket_cors(Bucket=S3_BUCKET)
-            cors_configured = True
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchCORSConfiguration':
-                cors_configured = False
-            else:
-                raise e
-        
-        # Check bucket policy
-        try:
-            policy = s3_client.get_bucket_policy(Bucket=S3_BUCKET)
-            has_policy = True
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchBucketPolicy':
-                has_policy = False
-            else:
-                raise e
-        
-        # Test image access
-        test_url = s3_client.generate_presigned_url(
+def check_s3_config_endpoint():
+    """S3 configuration and permissions, from the latest background check"""
+    results, error = s3_check_results()
+    if error:
+        return error
+    bucket, config = results
+    details = config["details"]
+    return jsonify({
+        "status": "success",
+        "bucket": S3_BUCKET,
+        "cors_configured": details["cors_configured"],
+        "has_policy": details["has_policy"],
+        "test_image_url": get_s3_client().generate_presigned_url(
             'get_object',
             Params={'Bucket': S3_BUCKET, 'Key': 'character_images/naruto.jpg'},
             ExpiresIn=3600
-        )
-        
-        return jsonify({
-            "status": "success",
-            "bucket": S3_BUCKET,
-            "cors_configured": cors_configured,
-            "has_policy": has_policy,
-            "test_image_url": test_url,
-            "region": os.getenv('AWS_REGION', 'ap-southeast-2')
-        })
-    except Exception as e:
-        return jsonify({
-            "status": "error",
-            "message": str(e),
-            "bucket": S3_BUCKET,
-            "region": os.getenv('AWS_REGION', 'ap-southeast-2')
-        })
+        ),
+        "region": AWS_REGION,
+        "checked_at": config["checked_at"]
+    })
 
 @app.route("/test_s3")
 def test_s3():
-    """Debug endpoint to test S3 connectivity"""
-    if not s3_client or not S3_BUCKET:
-        return jsonify({
-            "status": "error",
-            "message": "S3 not configured",
-            "bucket": S3_BUCKET,
-            "client": bool(s3_client)
-        })
-    
-    try:
-        # List objects in character_images/
-        response = s3_client.list_objects_v2(
-            Bucket=S3_BUCKET,
-            Prefix='character_images/',
-            MaxKeys=10
-        )
-        
-        # Test listing chat_history/
-        chat_response = s3_client.list_objects_v2(
-            Bucket=S3_BUCKET,
-            Prefix='chat_history/',
-            MaxKeys=10
-        )
-        
-        return jsonify({
-            "status": "success",
-            "bucket": S3_BUCKET,
-            "character_images": [obj['Key'] for obj in response.get('Contents', [])],
-            "chat_histories": [obj['Key'] for obj in chat_response.get('Contents', [])],
-            "cors": bool(s3_client.get_bucket_cors(Bucket=S3_BUCKET))
-        })
-    except Exception as e:
-        return jsonify({
-            "status": "error",
-            "message": str(e),
-            "bucket": S3_BUCKET
-        })
+    """Debug endpoint showing S3 connectivity and sample keys, from the latest background check"""
+    results, error = s3_check_results()
+    if error:
+        return error
+    bucket, config = results
+    details = config["details"]
+    return jsonify({
+        "status": "success",
+        "bucket": S3_BUCKET,
+        "character_images": details["character_images"],
+        "chat_histories": details["chat_histories"],
+        "cors": details["cors_configured"],
+        "checked_at": config["checked_at"]
+    })
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True)
@@ -0,0 +1,222 @@
+"""On-disk cache of character avatars, with resized variants
+
+``/avatars/<character>`` is served from here instead of presigned S3 URLs, so
+the URL never changes and browsers and CDNs can cache it. An image is fetched
+from S3 once into ``directory`` and kept for ``ttl`` seconds before it is
+fetched again (a stale copy is still served if S3 is unreachable). Resized
+variants (``?size=``, rounded up to one of ``sizes``; larger requests get the
+original) are made from the cached original with Pillow, if installed;
+without it every size is the original.
+
+Files are written atomically, so several workers can share the directory.
+Once it holds more than ``max_bytes`` the oldest files are removed. Images
+missing from S3 are remembered for ``missing_ttl`` seconds.
+"""
+import os, io, time, hashlib, logging, tempfile, threading
+from collections import namedtuple
+
+from botocore.exceptions import ClientError, BotoCoreError
+
+from metrics import counter
+from storage import get_s3_client
+
+try:
+    from PIL import Image
+except ImportError:  # optional
+    Image = None
+
+AVATAR_CACHE_DIR = os.getenv("AVATAR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "avatar-cache"))
+AVATAR_CACHE_MAX_BYTES = int(os.getenv("AVATAR_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+AVATAR_CACHE_TTL = float(os.getenv("AVATAR_CACHE_TTL", "86400"))
+AVATAR_MISSING_TTL = float(os.getenv("AVATAR_MISSING_TTL", "60"))
+AVATAR_SIZES = os.getenv("AVATAR_SIZES", "48,96")  # thumbnail edge lengths in pixels
+
+AVATAR_LOOKUPS = counter("avatar_cache_lookups_total", "Avatar lookups by result", ["result"])
+
+log = logging.getLogger(__name__)
+
+Avatar = namedtuple("Avatar", "path mimetype etag")
+
+_image_types = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"RIFF", "image/webp")
+)
+
+
+def sniff_mimetype(head):
+    for magic, mimetype in _image_types:
+        if head.startswith(magic):
+            return mimetype
+    return "application/octet-stream"
+
+
+def resize(data, size):
+    """Scale an image down to fit in size x size; PNG if it has transparency, else JPEG"""
+    with Image.open(io.BytesIO(data)) as img:
+        img.thumbnail((size, size))
+        out = io.BytesIO()
+        if img.mode in ("RGBA", "LA", "P"):
+            img.save(out, format="PNG", optimize=True)
+        else:
+            img.convert("RGB").save(out, format="JPEG", quality=85, optimize=True)
+    return out.getvalue()
+
+
+class AvatarCache:
+    def __init__(self, bucket, s3_client=None, directory=AVATAR_CACHE_DIR, max_bytes=AVATAR_CACHE_MAX_BYTES,
+                 ttl=AVATAR_CACHE_TTL, missing_ttl=AVATAR_MISSING_TTL, sizes=AVATAR_SIZES):
+        self.bucket = bucket
+        self._s3 = s3_client
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self.sizes = sorted({int(s) for s in sizes.split(",") if s.strip()}) if isinstance(sizes, str) \
+            else sorted(set(sizes))
+        if self.sizes and Image is None:
+            log.warning("Pillow is not installed, avatars are served at their original size")
+            self.sizes = []
+        self._lock = threading.Lock()
+        self._key_locks = {}  # image key -> [lock, users]
+        self._etags = {}  # path -> (mtime_ns, mimetype, etag)
+        self._missing = {}  # image key -> missing until
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            self._s3 = get_s3_client()
+        return self._s3
+
+    def variant(self, size):
+        """Smallest configured size that is at least ``size``, or None for the original"""
+        if not size or not self.sizes:
+            return None
+        return next((s for s in self.sizes if s >= size), None)
+
+    def path(self, image_key, variant):
+        digest = hashlib.sha1(image_key.encode("utf-8")).hexdigest()[:24]
+        return os.path.join(self.directory, f"{digest}-{variant or 'orig'}")
+
+    def _cached(self, path, fresh=True):
+        """The Avatar stored at path, or None if there is none (or it is stale and fresh is set)"""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if fresh and time.time() - st.st_mtime >= self.ttl:
+            return None
+        known = self._etags.get(path)
+        if known is None or known[0] != st.st_mtime_ns:
+            with open(path, "rb") as f:
+                data = f.read()
+            known = (st.st_mtime_ns, sniff_mimetype(data[:16]), hashlib.sha1(data).hexdigest()[:20])
+            self._etags[path] = known
+        return Avatar(path, known[1], known[2])
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _locked(self, image_key):
+        # One fetch per image at a time; the lock is dropped again once nobody waits on it
+        with self._lock:
+            entry = self._key_locks.setdefault(image_key, [threading.Lock(), 0])
+            entry[1] += 1
+        return entry
+
+    def _unlock(self, image_key, entry):
+        with self._lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._key_locks[image_key]
+
+    def get(self, image_key, size=None):
+        """Avatar for an S3 image key at about ``size`` pixels, or None if the image does not exist"""
+        variant = self.variant(size)
+        path = self.path(image_key, variant)
+        avatar = self._cached(path)
+        if avatar:
+            AVATAR_LOOKUPS.inc(result="hit")
+            return avatar
+        if self._missing.get(image_key, 0) > time.time():
+            AVATAR_LOOKUPS.inc(result="missing")
+            return None
+
+        entry = self._locked(image_key)
+        try:
+            with entry[0]:
+                avatar = self._cached(path)  # fetched while we waited
+                if avatar:
+                    AVATAR_LOOKUPS.inc(result="hit")
+                    return avatar
+                AVATAR_LOOKUPS.inc(result="miss")
+                return self._fill(image_key, variant, path)
+        finally:
+            self._unlock(image_key, entry)
+
+    def _fill(self, image_key, variant, path):
+        original_path = self.path(image_key, None)
+        original = self._cached(original_path)
+        if original is None:
+            try:
+                data = self.s3.get_object(Bucket=self.bucket, Key=image_key)["Body"].read()
+            except (ClientError, BotoCoreError) as e:
+                # Unreachable S3 (EndpointConnectionError etc.) falls back to a stale copy too
+                if isinstance(e, ClientError) and e.response["Error"].get("Code", "") in ("NoSuchKey", "404"):
+                    self._missing[image_key] = time.time() + self.missing_ttl
+                    return None
+                stale = self._cached(path, fresh=False) or self._cached(original_path, fresh=False)
+                if stale is None:
+                    raise
+                log.warning("Serving stale avatar for %s: %s", image_key, e)
+                return stale
+            self._missing.pop(image_key, None)
+            self._write(original_path, data)
+        else:
+            with open(original_path, "rb") as f:
+                data = f.read()
+        if variant:
+            try:
+                self._write(path, resize(data, variant))
+            except (OSError, ValueError) as e:  # not an image Pillow can read
+                log.warning("Could not resize avatar %s: %s", image_key, e)
+                path = original_path
+        avatar = self._cached(path, fresh=False)
+        self._evict(keep={original_path, path})
+        return avatar
+
+    def _evict(self, keep=()):
+        """Remove the oldest files (other than those in keep) until the directory is within max_bytes"""
+        files = []
+        total = 0
+        with os.scandir(self.directory) as entries:
+            for e in entries:
+                if e.is_file() and not e.name.startswith(".tmp-"):
+                    st = e.stat()
+                    total += st.st_size
+                    if e.path not in keep:
+                        files.append((st.st_mtime, st.st_size, e.path))
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(files):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._etags.pop(path, None)
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self):
+        return {
+            "sizes": self.sizes,
+            "resizing": Image is not None,
+            "tracked_files": len(self._etags),
+            "missing": sum(1 for until in self._missing.values() if until > time.time())
+        }
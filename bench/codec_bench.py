@@ -0,0 +1,71 @@
+"""Compression ratio and encode/decode time of the history encodings
+
+Builds synthetic chat histories shaped like the ones the app stores and
+reports, for every encoding/layout combination, the object size relative to
+plain JSON rows and the median time to encode and decode it.
+
+    python bench/codec_bench.py --sizes 50,500 --repeat 50
+"""
+import argparse, os, random, statistics, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from history_codec import HistoryCodec, zstandard  # noqa: E402
+
+WORDS = ("believe it never give up training hard every day makes us stronger together "
+         "ramen ninja village hokage friends power team mission chakra shadow clone").split()
+CHARACTERS = ["Naruto", "Goku", "Iron Man"]
+
+
+def make_history(size, seed=0):
+    rng = random.Random(seed)
+    now = 1_700_000_000.0
+    history = []
+    for i in range(size // 2):
+        chat_id = f"chat-{i // 20}"
+        now += rng.uniform(5, 120)
+        history.append({"role": "user", "content": " ".join(rng.choices(WORDS, k=rng.randint(3, 25))),
+                        "timestamp": now, "chatId": chat_id})
+        history.append({"role": "assistant", "content": " ".join(rng.choices(WORDS, k=rng.randint(10, 80))),
+                        "character": rng.choice(CHARACTERS), "timestamp": now + rng.uniform(1, 5),
+                        "chatId": chat_id})
+    return history
+
+
+def median_ms(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="50,500", help="messages per history")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    encodings = ["json", "gzip"] + (["zstd"] if zstandard else [])
+    combos = [(encoding, layout) for encoding in encodings for layout in ("rows", "columns")]
+    if not zstandard:
+        print("zstandard not installed, skipping zstd\n")
+
+    print(f"{'messages':>8}  {'encoding':<8} {'layout':<8} {'bytes':>9} {'ratio':>6} {'encode ms':>10} {'decode ms':>10}")
+    for size in [int(s) for s in args.sizes.split(",") if s]:
+        history = make_history(size)
+        baseline = len(HistoryCodec("json", "rows").encode(history))
+        for encoding, layout in combos:
+            codec = HistoryCodec(encoding, layout)
+            body = codec.encode(history)
+            assert codec.decode(body) == history
+            encode = median_ms(lambda: codec.encode(history), args.repeat)
+            decode = median_ms(lambda: codec.decode(body), args.repeat)
+            print(f"{size:>8}  {encoding:<8} {layout:<8} {len(body):>9} {baseline / len(body):>5.1f}x "
+                  f"{encode:>10.3f} {decode:>10.3f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""In-memory S3 stand-in speaking enough of the S3 REST API for the app
+
+Supports path-style GET/PUT/HEAD/DELETE object (including If-Match /
+If-None-Match conditional PUTs), multi-object delete, ListObjectsV2 (with
+delimiters) and the bucket-level calls used by the diagnostics endpoints.
+Point boto3 at it with ``AWS_ENDPOINT_URL_S3=http://127.0.0.1:<port>``. Every
+request can be delayed by ``--latency-ms`` to approximate real S3 round trips.
+
+    python bench/fake_s3.py --port 9000 --latency-ms 15
+"""
+import argparse, hashlib, threading, time
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ET
+
+S3_NS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class Bucket:
+    def __init__(self):
+        self.objects = {}  # key -> (body, etag, last_modified)
+        self.config = {}  # "cors" / "policy" -> raw body
+        self.lock = threading.Lock()
+
+
+class S3State:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def bucket(self, name):
+        with self.lock:
+            self.requests += 1
+            if name not in self.buckets:
+                self.buckets[name] = Bucket()
+            return self.buckets[name]
+
+
+def decode_aws_chunked(body):
+    """Strip aws-chunked framing (``<hex size>[;ext]\\r\\n<data>\\r\\n`` ... trailers)"""
+    out = bytearray()
+    pos = 0
+    while pos < len(body):
+        end = body.index(b"\r\n", pos)
+        size = int(body[pos:end].split(b";")[0], 16)
+        pos = end + 2
+        if size == 0:
+            break
+        out += body[pos:pos + size]
+        pos += size + 2
+    return bytes(out)
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        # Helpers
+        def _route(self):
+            parts = urlsplit(self.path)
+            path = unquote(parts.path).lstrip("/")
+            bucket, _, key = path.partition("/")
+            query = {k: v[0] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+            if state.latency:
+                time.sleep(state.latency)
+            return state.bucket(bucket), bucket, key, query
+
+        def _body(self):
+            if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                body = bytearray()
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        break
+                    body += self.rfile.read(size)
+                    self.rfile.readline()
+                body = bytes(body)
+            else:
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            sha = self.headers.get("x-amz-content-sha256", "")
+            if sha.startswith("STREAMING-") or "aws-chunked" in self.headers.get("Content-Encoding", ""):
+                body = decode_aws_chunked(body)
+            return body
+
+        def _send(self, status, body=b"", headers=None, content_type="application/xml"):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            if body or self.command != "HEAD":
+                self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if body and self.command != "HEAD":
+                self.wfile.write(body)
+
+        def _error(self, status, code, message=""):
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code>'
+                    f"<Message>{escape(message or code)}</Message></Error>").encode()
+            self._send(status, body if self.command != "HEAD" else b"")
+
+        # Verbs
+        def do_HEAD(self):
+            bucket, _, key, _ = self._route()
+            if not key:
+                return self._send(200)
+            obj = bucket.objects.get(key)
+            if obj is None:
+                return self._error(404, "NoSuchKey")
+            self.send_response(200)
+            self.send_header("ETag", obj[1])
+            self.send_header("Last-Modified", formatdate(obj[2], usegmt=True))
+            self.send_header("Content-Length", str(len(obj[0])))
+            self.end_headers()
+
+        def do_GET(self):
+            bucket, name, key, query = self._route()
+            if not key:
+                if query.get("list-type") == "2":
+                    return self._list(bucket, name, query)
+                for sub, missing in (("cors", "NoSuchCORSConfiguration"), ("policy", "NoSuchBucketPolicy")):
+                    if sub in query:
+                        if sub not in bucket.config:
+                            return self._error(404, missing)
+                        return self._send(200, bucket.config[sub])
+                return self._list(bucket, name, query)
+            obj = bucket.objects.get(key)
+            if obj is None:
+                return self._error(404, "NoSuchKey", "The specified key does not exist.")
+            if self.headers.get("If-None-Match") == obj[1]:
+                return self._send(304, headers={"ETag": obj[1]})
+            self._send(200, obj[0], {"ETag": obj[1], "Last-Modified": formatdate(obj[2], usegmt=True)},
+                       content_type="application/octet-stream")
+
+        def do_PUT(self):
+            bucket, _, key, query = self._route()
+            body = self._body()
+            if not key:
+                for sub in ("cors", "policy"):
+                    if sub in query:
+                        bucket.config[sub] = body
+                return self._send(200 if "cors" in query else 204)
+            with bucket.lock:
+                current = bucket.objects.get(key)
+                if_none_match = self.headers.get("If-None-Match")
+                if_match = self.headers.get("If-Match")
+                if if_none_match == "*" and current is not None:
+                    return self._error(412, "PreconditionFailed", "At least one of the pre-conditions you specified did not hold")
+                if if_match is not None and (current is None or current[1] != if_match):
+                    code = 404 if current is None else 412
+                    return self._error(code, "NoSuchKey" if current is None else "PreconditionFailed")
+                etag = f'"{hashlib.md5(body).hexdigest()}"'
+                bucket.objects[key] = (body, etag, time.time())
+            self._send(200, headers={"ETag": etag})
+
+        def do_DELETE(self):
+            bucket, _, key, _ = self._route()
+            with bucket.lock:
+                bucket.objects.pop(key, None)
+            self._send(204)
+
+        def do_POST(self):
+            bucket, _, _, query = self._route()
+            body = self._body()
+            if "delete" not in query:
+                return self._error(400, "NotImplemented")
+            root = ET.fromstring(body)
+            keys = [el.text for el in root.iter() if el.tag.endswith("Key")]
+            with bucket.lock:
+                for key in keys:
+                    bucket.objects.pop(key, None)
+            self._send(200, f'<?xml version="1.0" encoding="UTF-8"?><DeleteResult xmlns="{S3_NS}"/>'.encode())
+
+        def _list(self, bucket, name, query):
+            prefix = query.get("prefix", "")
+            max_keys = int(query.get("max-keys", 1000))
+            start_after = query.get("continuation-token") or query.get("start-after") or ""
+            delimiter = query.get("delimiter", "")
+            with bucket.lock:
+                keys = sorted(k for k in bucket.objects if k.startswith(prefix) and k > start_after)
+                # Entries are (name, object or None for a common prefix), rolled up by the delimiter
+                entries = []
+                for k in keys:
+                    cut = k.find(delimiter, len(prefix)) if delimiter else -1
+                    if cut == -1:
+                        entries.append((k, bucket.objects[k]))
+                        continue
+                    common = k[:cut + len(delimiter)]
+                    if common != start_after and (not entries or entries[-1][0] != common):
+                        entries.append((common, None))
+                page = entries[:max_keys]
+            truncated = len(entries) > max_keys
+            contents = "".join(
+                f"<Contents><Key>{escape(k)}</Key>"
+                f"<LastModified>{time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(obj[2]))}</LastModified>"
+                f"<ETag>{escape(obj[1])}</ETag><Size>{len(obj[0])}</Size>"
+                f"<StorageClass>STANDARD</StorageClass></Contents>"
+                for k, obj in page if obj is not None
+            )
+            prefixes = "".join(f"<CommonPrefixes><Prefix>{escape(k)}</Prefix></CommonPrefixes>"
+                               for k, obj in page if obj is None)
+            token = f"<NextContinuationToken>{escape(page[-1][0])}</NextContinuationToken>" if truncated else ""
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="{S3_NS}">'
+                    f"<Name>{escape(name)}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>"
+                    f"<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{str(truncated).lower()}</IsTruncated>"
+                    f"{contents}{prefixes}{token}</ListBucketResult>")
+            self._send(200, body.encode())
+
+    return Handler
+
+
+def serve(port=9000, latency_ms=0.0, host="127.0.0.1"):
+    state = S3State(latency_ms / 1000)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    return server, state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay added to every request")
+    args = parser.parse_args()
+    server, _ = serve(args.port, args.latency_ms, args.host)
+    print(f"Fake S3 listening on http://{args.host}:{args.port}", flush=True)
+    server.serve_forever()
@@ -0,0 +1,342 @@
+"""Offline load test for the app against local S3 and LLM stand-ins
+
+Starts ``bench/fake_s3.py`` and ``bench/stub_llm.py`` as subprocesses, seeds
+chat histories of the requested sizes, starts the app (Flask dev server or
+gunicorn with any worker configuration) pointed at them, and drives each
+endpoint at each concurrency level. Reports throughput and p50/p95/p99
+latency (plus time-to-first-token for streaming) and writes the results to
+``bench/results/<label>-<timestamp>.json``.
+
+    python bench/run.py --label baseline
+    python bench/run.py --server gunicorn --gunicorn-args "-w 4 -k gthread --threads 16" --label gthread
+    python bench/run.py --server gunicorn --gunicorn-args "-w 1 -k gevent" --label gevent --concurrency 64,256
+    python bench/run.py --compare bench/results/baseline-*.json bench/results/gthread-*.json
+
+Everything runs locally; no AWS credentials or network access are needed.
+"""
+import argparse, json, math, os, shlex, socket, subprocess, sys, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+BUCKET = "bench"
+CHARACTER = "Goku"
+
+# name -> (method, path, JSON body, depends on history size)
+ENDPOINTS = {
+    "index": ("GET", "/", None, False),
+    "chats": ("GET", "/api/chats", None, True),
+    "messages": ("GET", "/api/chats/chat-0/messages", None, True),
+    "chat": ("POST", "/chat", {"message": "Who are you?", "character": CHARACTER, "chatId": "chat-0"}, True),
+    "chat_stream": ("POST", "/chat/stream", {"message": "Who are you?", "character": CHARACTER, "chatId": "chat-0"}, True),
+    "image": ("POST", "/get_character_image", {"character": CHARACTER}, False),
+}
+
+
+# Processes
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"process exited early with code {proc.returncode}: {' '.join(proc.args)}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+
+
+def start(cmd, port, env=None):
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port, proc)
+    return proc
+
+
+def app_env(args, s3_port, llm_port):
+    env = dict(os.environ)
+    env.update({
+        "S3_BUCKET": BUCKET,
+        "AWS_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_ENDPOINT_URL_S3": f"http://127.0.0.1:{s3_port}",
+        "CHUTES_API_KEY": "bench",
+        "CHUTES_BASE_URL": f"http://127.0.0.1:{llm_port}/v1/chat/completions",
+        "DEMO_MODE": "false",
+        "CHAT_USER_RATE": "0",  # a few seeded users send every request, don't rate-limit them
+    })
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    return env
+
+
+def app_command(args, port):
+    if args.server == "gunicorn":
+        return [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}",
+                *shlex.split(args.gunicorn_args), "app:app"]
+    return [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port), "--with-threads"]
+
+
+# Seeding
+def seed(env, sizes, users):
+    """Write the character image and a history of each size for ``users`` users into the fake S3"""
+    os.environ.update({k: env[k] for k in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_ENDPOINT_URL_S3", "AWS_REGION")})
+    sys.path.insert(0, ROOT)
+    import boto3
+    from character_registry import image_key
+    from history_store import HistoryStore
+
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    s3_client.put_object(Bucket=BUCKET, Key=image_key(CHARACTER), Body=b"\xff\xd8\xff\xe0" + b"\0" * 4096,
+                         ContentType="image/jpeg")
+
+    store = HistoryStore(BUCKET, s3_client=s3_client, max_messages=max(sizes + [1]))
+    now = time.time()
+    for size in sizes:
+        history = []
+        for i in range(size):
+            history.append({
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": f"Message {i} " + "lorem ipsum dolor sit amet " * 4,
+                "character": CHARACTER if i % 2 else None,
+                "timestamp": now - size + i,
+                "chatId": f"chat-{i // 20}"
+            })
+        for u in range(users):
+            store.save(user_id(size, u), history)
+
+
+def user_id(size, index):
+    return f"bench-h{size}-u{index}"
+
+
+# Load generation
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "mean": round(sum(values) / len(values), 2),
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "max": round(values[-1], 2)
+    }
+
+
+def one_request(session, base_url, endpoint):
+    method, path, body, _ = ENDPOINTS[endpoint]
+    # Every chat request is a new turn; the same body without a fresh key would be
+    # answered by the app's duplicate detection instead of the model
+    headers = {"Idempotency-Key": uuid.uuid4().hex} if endpoint in ("chat", "chat_stream") else None
+    started = time.perf_counter()
+    ttft = None
+    if endpoint == "chat_stream":
+        with session.post(base_url + path, json=body, headers=headers, stream=True, timeout=120) as resp:
+            ok = resp.status_code == 200
+            for line in resp.iter_lines():
+                if ttft is None and line.startswith(b"data:"):
+                    ttft = (time.perf_counter() - started) * 1000
+    else:
+        resp = session.request(method, base_url + path, json=body, headers=headers, timeout=120)
+        resp.content  # read the full body
+        ok = resp.status_code < 400
+    return (time.perf_counter() - started) * 1000, ttft, ok, resp.status_code
+
+
+def run_case(base_url, endpoint, history_size, concurrency, total, warmup, users):
+    counter = iter(range(total + warmup))
+    lock = threading.Lock()
+    samples = []
+
+    def worker(index):
+        # One keep-alive session (and one user) per simulated client
+        session = requests.Session()
+        session.cookies.set("user_id", user_id(history_size, index % users))
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            try:
+                result = one_request(session, base_url, endpoint)
+            except requests.RequestException:
+                result = (None, None, False, None)
+            if n >= warmup:
+                with lock:
+                    samples.append(result)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    duration = time.perf_counter() - started
+
+    latencies = [s[0] for s in samples if s[2]]
+    ttfts = [s[1] for s in samples if s[2] and s[1] is not None]
+    statuses = {}
+    for s in samples:
+        statuses[str(s[3])] = statuses.get(str(s[3]), 0) + 1
+    return {
+        "endpoint": endpoint,
+        "history_size": history_size,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": sum(1 for s in samples if not s[2]),
+        "statuses": statuses,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(samples) / duration, 2) if duration else None,
+        "latency_ms": summarize(latencies),
+        "ttft_ms": summarize(ttfts)
+    }
+
+
+# Reporting
+def fmt(stats, key):
+    return "-" if not stats else f"{stats[key]:.1f}"
+
+
+def print_table(results):
+    print(f"{'endpoint':<12} {'hist':>5} {'conc':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'ttft50':>8} {'err':>5}")
+    for r in results:
+        print(f"{r['endpoint']:<12} {r['history_size']:>5} {r['concurrency']:>5} {r['throughput_rps'] or 0:>8.1f} "
+              f"{fmt(r['latency_ms'], 'p50'):>8} {fmt(r['latency_ms'], 'p95'):>8} {fmt(r['latency_ms'], 'p99'):>8} "
+              f"{fmt(r['ttft_ms'], 'p50'):>8} {r['errors']:>5}")
+
+
+def compare(path_a, path_b):
+    with open(path_a) as f:
+        a = json.load(f)
+    with open(path_b) as f:
+        b = json.load(f)
+    key = lambda r: (r["endpoint"], r["history_size"], r["concurrency"])
+    baseline = {key(r): r for r in a["results"]}
+    print(f"{a['label']} -> {b['label']}")
+    print(f"{'endpoint':<12} {'hist':>5} {'conc':>5} {'rps':>18} {'p50 ms':>20} {'p99 ms':>20}")
+
+    def delta(old, new):
+        if old is None or new is None:
+            return "-"
+        change = (new - old) / old * 100 if old else 0.0
+        return f"{old:.1f}->{new:.1f} ({change:+.0f}%)"
+
+    def p(result, q):
+        return result["latency_ms"][q] if result["latency_ms"] else None
+
+    for r in b["results"]:
+        old = baseline.get(key(r))
+        if old is None:
+            continue
+        print(f"{r['endpoint']:<12} {r['history_size']:>5} {r['concurrency']:>5} "
+              f"{delta(old['throughput_rps'], r['throughput_rps']):>18} "
+              f"{delta(p(old, 'p50'), p(r, 'p50')):>20} {delta(p(old, 'p99'), p(r, 'p99')):>20}")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--server", choices=("flask", "gunicorn"), default="gunicorn")
+    parser.add_argument("--gunicorn-args", default="-w 2 -k gthread --threads 16")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--concurrency", type=int_list, default=[1, 8, 32])
+    parser.add_argument("--history-sizes", type=int_list, default=[0, 50, 500])
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per case")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests per case")
+    parser.add_argument("--users", type=int, default=32, help="distinct seeded users per history size")
+    parser.add_argument("--s3-latency-ms", type=float, default=15.0)
+    parser.add_argument("--llm-ttft-ms", type=float, default=200.0)
+    parser.add_argument("--llm-token-ms", type=float, default=10.0)
+    parser.add_argument("--llm-tokens", type=int, default=40)
+    parser.add_argument("--llm-rate-429", type=float, default=0.0)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the app, e.g. --env HISTORY_FLUSH_INTERVAL=0.5")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CANDIDATE"),
+                        help="compare two saved result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare(*args.compare)
+
+    endpoints = [e for e in args.endpoints.split(",") if e]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+    s3_port, llm_port, app_port = free_port(), free_port(), free_port()
+    procs = []
+    try:
+        procs.append(start([sys.executable, "bench/fake_s3.py", "--port", str(s3_port),
+                            "--latency-ms", str(args.s3_latency_ms)], s3_port))
+        procs.append(start([sys.executable, "bench/stub_llm.py", "--port", str(llm_port),
+                            "--ttft-ms", str(args.llm_ttft_ms), "--token-ms", str(args.llm_token_ms),
+                            "--tokens", str(args.llm_tokens), "--rate-429", str(args.llm_rate_429)], llm_port))
+        env = app_env(args, s3_port, llm_port)
+        seed(env, args.history_sizes, args.users)
+        procs.append(start(app_command(args, app_port), app_port, env))
+        base_url = f"http://127.0.0.1:{app_port}"
+
+        results = []
+        for endpoint in endpoints:
+            sizes = args.history_sizes if ENDPOINTS[endpoint][3] else args.history_sizes[:1]
+            for size in sizes:
+                for concurrency in args.concurrency:
+                    result = run_case(base_url, endpoint, size, concurrency, args.requests, args.warmup, args.users)
+                    results.append(result)
+                    print(f"  {endpoint} hist={size} conc={concurrency}: {result['throughput_rps']} rps, "
+                          f"p50={fmt(result['latency_ms'], 'p50')}ms p99={fmt(result['latency_ms'], 'p99')}ms "
+                          f"errors={result['errors']}", flush=True)
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    print()
+    print_table(results)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(RESULTS_DIR, f"{args.label}-{stamp}.json")
+    with open(path, "w") as f:
+        json.dump({
+            "label": args.label,
+            "timestamp": stamp,
+            "git_commit": git_commit(),
+            "config": {k: v for k, v in vars(args).items() if k != "compare"},
+            "results": results
+        }, f, indent=2)
+    print(f"\nSaved results to {os.path.relpath(path, ROOT)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Stub OpenAI-compatible chat completions server with tunable latency
+
+Answers ``POST /v1/chat/completions`` (any path, really) with a canned reply
+of ``--tokens`` words. Non-streaming responses arrive after
+``ttft + tokens * token`` ms; with ``"stream": true`` the first delta is sent
+after ``--ttft-ms`` and each following one ``--token-ms`` later. A fraction
+``--rate-429`` of requests is rejected with 429 and ``Retry-After``.
+
+    python bench/stub_llm.py --port 9001 --ttft-ms 300 --token-ms 20 --rate-429 0.05
+"""
+import argparse, json, random, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+WORDS = "believe it and never give up because training hard every day makes us stronger together".split()
+
+
+class Config:
+    def __init__(self, ttft_ms=200.0, token_ms=10.0, tokens=40, rate_429=0.0, retry_after=1, jitter=0.1):
+        self.ttft = ttft_ms / 1000
+        self.token = token_ms / 1000
+        self.tokens = tokens
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.jitter = jitter
+
+
+def make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _sleep(self, seconds):
+            if seconds > 0:
+                time.sleep(seconds * random.uniform(1 - config.jitter, 1 + config.jitter))
+
+        def _json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _chunk(self, text):
+            data = text.encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if config.rate_429 and random.random() < config.rate_429:
+                return self._json(429, {"error": {"message": "Rate limit exceeded"}},
+                                  {"Retry-After": str(config.retry_after)})
+
+            words = [random.choice(WORDS) for _ in range(config.tokens)]
+            prompt_tokens = sum(len(m.get("content", "")) // 4 + 1 for m in request.get("messages", []))
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                     "total_tokens": prompt_tokens + len(words)}
+            model = request.get("model", "stub")
+
+            if not request.get("stream"):
+                self._sleep(config.ttft + config.token * len(words))
+                return self._json(200, {
+                    "id": "stub", "object": "chat.completion", "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)},
+                                 "finish_reason": "stop"}],
+                    "usage": usage
+                })
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self._sleep(config.ttft)
+            for i, word in enumerate(words):
+                if i:
+                    self._sleep(config.token)
+                chunk = {"id": "stub", "object": "chat.completion.chunk", "model": model,
+                         "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}}]}
+                self._chunk(f"data: {json.dumps(chunk)}\n\n")
+            final = {"id": "stub", "object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+            self._chunk(f"data: {json.dumps(final)}\n\n")
+            self._chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def serve(port=9001, host="127.0.0.1", **config):
+    server = ThreadingHTTPServer((host, port), make_handler(Config(**config)))
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--ttft-ms", type=float, default=200.0, help="delay before the first token")
+    parser.add_argument("--token-ms", type=float, default=10.0, help="delay between tokens")
+    parser.add_argument("--tokens", type=int, default=40, help="words per reply")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+    args = parser.parse_args()
+    server = serve(args.port, args.host, ttft_ms=args.ttft_ms, token_ms=args.token_ms, tokens=args.tokens,
+                   rate_429=args.rate_429, retry_after=args.retry_after)
+    print(f"Stub LLM listening on http://{args.host}:{args.port}", flush=True)
+    server.serve_forever()
@@ -0,0 +1,121 @@
+"""Indexed character roster, reloaded when characters.json changes
+
+Each character is stored with its precomputed ``slug``, ``system_prompt`` and
+``image_key`` and indexed by name and slug for O(1) lookups. The file's mtime
+is checked at most every ``check_interval`` seconds; a changed file is loaded
+into a new snapshot that replaces the old one atomically, so a roster edit
+needs no restart. A file that fails to parse leaves the current roster in
+place.
+"""
+import os, logging, json, re, threading, time
+
+from context import system_prompt
+
+CHARACTERS_FILE = os.getenv("CHARACTERS_FILE", "characters.json")
+CHARACTERS_RELOAD_INTERVAL = float(os.getenv("CHARACTERS_RELOAD_INTERVAL", "2"))
+
+log = logging.getLogger(__name__)
+
+_non_slug = re.compile(r"[^a-z0-9]+")
+
+
+def slugify(name):
+    return _non_slug.sub("_", name.lower()).strip("_")
+
+
+def image_key(name):
+    # Convert to lowercase and replace spaces with underscores
+    return f"character_images/{name.lower().replace(' ', '_')}.jpg"
+
+
+class _Snapshot:
+    __slots__ = ("version", "characters", "by_name", "by_slug", "search_text")
+
+    def __init__(self, version, raw):
+        self.version = version
+        self.characters = []
+        self.by_name = {}
+        self.by_slug = {}
+        for c in raw:
+            char = {
+                **c,
+                "slug": slugify(c["name"]),
+                "system_prompt": system_prompt(c["name"], c.get("traits", ""), c.get("style", "")),
+                "image_key": image_key(c["name"])
+            }
+            self.characters.append(char)
+            self.by_name.setdefault(char["name"], char)
+            self.by_slug.setdefault(char["slug"], char)
+        self.search_text = [
+            " ".join(str(c.get(field) or "") for field in ("name", "alias", "universe", "traits")).lower()
+            for c in self.characters
+        ]
+
+
+class CharacterRegistry:
+    def __init__(self, path=CHARACTERS_FILE, check_interval=CHARACTERS_RELOAD_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._checked = 0.0
+        self._mtime = None
+        self._snapshot = _Snapshot("0", [])
+        self._maybe_reload(force=True)
+
+    def _maybe_reload(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if not force and now - self._checked < self.check_interval:
+                return
+            self._checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self._mtime:
+                    return
+                with open(self.path) as f:
+                    raw = json.load(f)
+                self._snapshot = _Snapshot(f"{mtime:x}-{len(raw)}", raw)
+                self._mtime = mtime
+                log.info("Loaded %d characters from %s", len(raw), self.path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                log.error("Error loading characters from %s: %s", self.path, e)
+
+    @property
+    def snapshot(self):
+        self._maybe_reload()
+        return self._snapshot
+
+    @property
+    def version(self):
+        """Changes whenever the roster is reloaded with different content"""
+        return self.snapshot.version
+
+    def all(self):
+        return self.snapshot.characters
+
+    def get(self, name):
+        """Look a character up by exact name or slug"""
+        snap = self.snapshot
+        if not name or not isinstance(name, str):
+            return None
+        return snap.by_name.get(name) or snap.by_slug.get(slugify(name))
+
+    def default(self):
+        characters = self.snapshot.characters
+        return characters[0] if characters else None
+
+    def resolve(self, name):
+        """Named character, falling back to the first one like the original lookup did"""
+        return self.get(name) or self.default()
+
+    def search(self, query="", limit=50, offset=0):
+        """Return (total, page) of characters whose name, alias, universe or traits contain query"""
+        snap = self.snapshot
+        query = (query or "").strip().lower()
+        if not query:
+            matches = snap.characters
+        else:
+            matches = [c for c, text in zip(snap.characters, snap.search_text) if query in text]
+        return len(matches), matches[offset:offset + limit]
@@ -0,0 +1,125 @@
+"""Token-budgeted prompt context for multi-turn chats
+
+The most recent turns of the current chat are packed newest-first into
+``CONTEXT_TOKEN_BUDGET`` estimated tokens. Turns that no longer fit are folded
+into a short rolling summary, built locally (no extra model call) from the
+first sentence of each folded turn and cached per user and chat so each turn
+is only folded once. Token counts use a cheap ~4 characters per token estimate.
+"""
+import os, re, threading
+from collections import OrderedDict
+from functools import lru_cache
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "400"))
+CONTEXT_SUMMARY_CACHE_SIZE = int(os.getenv("CONTEXT_SUMMARY_CACHE_SIZE", "5000"))
+
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators added per chat message
+SUMMARY_LINE_CHARS = 160
+
+_sentence_end = re.compile(r"(?<=[.!?])\s")
+
+
+def estimate_tokens(text):
+    """Rough token count, ~4 characters per token for English text"""
+    return len(text) // 4 + 1
+
+
+def message_tokens(message):
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+@lru_cache(maxsize=1024)
+def system_prompt(name, traits, style):
+    return f"""You are {name}. You possess the following traits: {traits}
+        Your communication style is: {style}
+        Respond naturally, staying in character at all times.
+        """
+
+
+def to_chat_message(msg, character=None):
+    """Map a stored history entry onto an OpenAI chat message
+
+    Replies by characters other than ``character`` (group chats, or a chat that
+    switched characters) are passed as named user content, so the model does
+    not take them for things it said itself.
+    """
+    role = msg.get("role") or msg.get("type", "user")
+    if role not in ("assistant", "ai"):
+        return {"role": "user", "content": msg["content"]}
+    speaker = msg.get("character")
+    if character and speaker and speaker != character:
+        return {"role": "user", "content": f"{speaker}: {msg['content']}"}
+    return {"role": "assistant", "content": msg["content"]}
+
+
+def summary_line(msg, character):
+    text = msg.get("content", "").strip().replace("\n", " ")
+    text = _sentence_end.split(text, 1)[0]
+    if len(text) > SUMMARY_LINE_CHARS:
+        text = text[:SUMMARY_LINE_CHARS - 3] + "..."
+    speaker = "User" if to_chat_message(msg)["role"] == "user" else (msg.get("character") or character)
+    return f"{speaker}: {text}"
+
+
+class ContextBuilder:
+    def __init__(self, budget=CONTEXT_TOKEN_BUDGET, summary_tokens=CONTEXT_SUMMARY_TOKENS,
+                 summary_cache_size=CONTEXT_SUMMARY_CACHE_SIZE):
+        self.budget = budget
+        self.summary_tokens = summary_tokens
+        self.summary_cache_size = summary_cache_size
+        self._summaries = OrderedDict()  # (user_id, chat_id) -> (last folded timestamp, lines)
+        self._lock = threading.Lock()
+
+    def build(self, system, history, chat_id, user_msg, user_id=None, character=""):
+        """Return the messages list for the upstream call"""
+        turns = [m for m in history if m.get("chatId") == chat_id and m.get("content")]
+        current = {"role": "user", "content": user_msg}
+        remaining = self.budget - estimate_tokens(system) - message_tokens(current) - MESSAGE_OVERHEAD_TOKENS
+
+        # Newest first until the budget runs out, keeping room for a summary if anything is left over
+        packed = []
+        split = len(turns)
+        for msg in reversed(turns):
+            cost = message_tokens(msg)
+            reserve = self.summary_tokens if split - 1 > 0 else 0
+            if cost + reserve > remaining:
+                break
+            packed.append(to_chat_message(msg, character))
+            remaining -= cost
+            split -= 1
+        packed.reverse()
+
+        messages = [{"role": "system", "content": system}]
+        if split > 0:
+            summary = self.summarize(user_id, chat_id, turns[:split], character)
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+        return messages + packed + [current]
+
+    def summarize(self, user_id, chat_id, folded, character=""):
+        """Extend the cached rolling summary of ``chat_id`` with newly folded turns
+
+        Without a ``user_id`` chat ids from different callers could collide, so
+        the summary is built from all of ``folded`` and not cached.
+        """
+        key = (user_id, chat_id)
+        last_ts, lines = None, []
+        if user_id is not None:
+            with self._lock:
+                last_ts, lines = self._summaries.get(key, (None, []))
+        new = [m for m in folded if last_ts is None or m.get("timestamp", 0) > last_ts]
+        if new:
+            lines = lines + [summary_line(m, character) for m in new]
+            # Rolling: drop the oldest lines once the summary exceeds its budget
+            total = sum(estimate_tokens(line) for line in lines)
+            while len(lines) > 1 and total > self.summary_tokens:
+                total -= estimate_tokens(lines.pop(0))
+            last_ts = max(m.get("timestamp", 0) for m in folded)
+        if user_id is None:
+            return "\n".join(lines)
+        with self._lock:
+            self._summaries[key] = (last_ts, lines)
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.summary_cache_size:
+                self._summaries.popitem(last=False)
+        return "\n".join(lines)
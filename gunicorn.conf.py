@@ -0,0 +1,31 @@
+# Gunicorn configuration, picked up automatically from the working directory
+#
+# GUNICORN_WORKER_CLASS=gevent (the default) serves each request on a
+# greenlet: gevent patches sockets, so the waits on the LLM (requests) and on
+# S3 (boto3) yield to other requests instead of pinning a worker, and one
+# process holds up to worker_connections concurrent chats. Set it to "sync" or
+# "gthread" to go back to one request per worker / thread.
+import os
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+
+def post_fork(server, worker):
+    """Size per-worker limits for hundreds of concurrent chats under gevent (explicit settings win)"""
+    # Runs in the worker before the app is imported, whichever way the worker class was chosen
+    if type(worker).__name__ == "GeventWorker":
+        from dotenv import load_dotenv
+        load_dotenv()  # so values from .env still take precedence over these defaults
+        os.environ.setdefault("LLM_MAX_IN_FLIGHT", "256")
+        os.environ.setdefault("LLM_MAX_QUEUE", "512")
+        os.environ.setdefault("LLM_POOL_MAXSIZE", "256")
+        os.environ.setdefault("S3_MAX_POOL_CONNECTIONS", "64")
+
+
+def worker_exit(server, worker):
+    """Write out queued chat history and log records before the worker goes away"""
+    from app import history_cache
+    from log import flush_logs
+    history_cache.drain()
+    flush_logs()
@@ -0,0 +1,123 @@
+"""Background dependency health checks
+
+A daemon thread runs every registered check on its own interval and keeps the
+latest result (ok, latency, details, last error) in a snapshot. ``/livez``,
+``/readyz`` and the S3 diagnostics endpoints only read that snapshot, so they
+can be polled as often as load balancers and dashboards like without adding
+S3 or LLM requests.
+
+A check is a function that returns a dict of details (or None) and raises on
+failure. Only ``critical`` checks decide readiness; a critical check that has
+not run yet, failed, or has not reported for ``stale_after`` seconds makes the
+worker not ready.
+"""
+import os, time, logging, threading
+
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "15"))
+HEALTH_STALE_AFTER = float(os.getenv("HEALTH_STALE_AFTER", str(HEALTH_CHECK_INTERVAL * 4)))
+
+log = logging.getLogger(__name__)
+
+
+class Check:
+    def __init__(self, name, probe, interval, critical):
+        self.name = name
+        self.probe = probe
+        self.interval = interval
+        self.critical = critical
+        self.next_run = 0.0
+        self.result = {"ok": None, "critical": critical, "checked_at": None}
+
+
+class HealthMonitor:
+    def __init__(self, interval=HEALTH_CHECK_INTERVAL, stale_after=HEALTH_STALE_AFTER):
+        self.interval = interval
+        self.stale_after = stale_after
+        self.checks = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self.started_at = time.time()
+
+    def add_check(self, name, probe, interval=None, critical=True):
+        self.checks[name] = Check(name, probe, interval or self.interval, critical)
+
+    def ensure_running(self):
+        """Start the probe thread in this process (again after a fork, threads do not survive it)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._loop, name="health-checks", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            now = time.monotonic()
+            for check in list(self.checks.values()):
+                if now >= check.next_run:
+                    self.run_check(check)
+                    check.next_run = time.monotonic() + check.interval
+            wait = min((c.next_run for c in self.checks.values()), default=now + self.interval) - time.monotonic()
+            time.sleep(max(0.1, wait))
+
+    def run_check(self, check):
+        started = time.perf_counter()
+        try:
+            details = check.probe()
+            error = None
+        except Exception as e:
+            details, error = None, f"{type(e).__name__}: {e}"
+        latency_ms = round((time.perf_counter() - started) * 1000, 2)
+        now = time.time()
+        previous = check.result
+        result = {
+            "ok": error is None,
+            "critical": check.critical,
+            "latency_ms": latency_ms,
+            "checked_at": now,
+            "details": details,
+            "last_ok_at": now if error is None else previous.get("last_ok_at"),
+            "last_error": error or previous.get("last_error"),
+            "last_error_at": now if error else previous.get("last_error_at"),
+            "consecutive_failures": 0 if error is None else previous.get("consecutive_failures", 0) + 1
+        }
+        if error and previous.get("ok") is not False:
+            log.warning("Health check %s failed: %s", check.name, error)
+        elif not error and previous.get("ok") is False:
+            log.info("Health check %s recovered", check.name)
+        check.result = result  # replaced as a whole, readers never see a partial result
+
+    def result(self, name):
+        check = self.checks.get(name)
+        return check.result if check else None
+
+    def snapshot(self):
+        now = time.time()
+        checks = {name: dict(check.result) for name, check in self.checks.items()}
+        ready = True
+        for name, result in checks.items():
+            result["stale"] = result["checked_at"] is None or now - result["checked_at"] > self.stale_after
+            if result["critical"] and (not result["ok"] or result["stale"]):
+                ready = False
+        degraded = any(not r["ok"] for r in checks.values() if r["checked_at"] is not None)
+        return {
+            "status": "degraded" if ready and degraded else "ready" if ready else "not_ready",
+            "ready": ready,
+            "uptime": round(now - self.started_at, 1),
+            "checks": checks
+        }
+
+    def collect(self):
+        """Per-dependency gauges for /metrics"""
+        up, latency = {}, {}
+        for name, check in self.checks.items():
+            result = check.result
+            if result["checked_at"] is None:
+                continue
+            up[(("dependency", name),)] = 1 if result["ok"] else 0
+            latency[(("dependency", name),)] = result["latency_ms"] / 1000
+        return [
+            ("dependency_up", "Whether the last health check of a dependency passed", up),
+            ("dependency_check_seconds", "Duration of the last health check of a dependency", latency)
+        ]
@@ -0,0 +1,235 @@
+"""Per-worker write-behind cache in front of the chat history store
+
+Loaded histories are kept in an LRU keyed by ``user_id`` and are re-read
+from the store once they are older than ``ttl`` seconds. New messages are
+added to the cached copy immediately and queued; a background thread flushes each user's queue to the
+store once it has been dirty for ``flush_interval`` seconds, so several turns
+sent within that window become a single append. Due users are written
+concurrently on up to ``flush_workers`` threads (the store serializes writes
+per user). ``drain()`` flushes whatever is still pending and is called on
+shutdown.
+
+The cache is per process: another worker may serve a copy that is up to
+``ttl`` seconds stale for the same user.
+"""
+import os, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "1000"))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "300"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "2"))
+HISTORY_FLUSH_WORKERS = int(os.getenv("HISTORY_FLUSH_WORKERS", "16"))
+
+
+class _Entry:
+    __slots__ = ("history", "loaded", "loaded_at", "pending", "flushing", "flushed", "dirty_since", "accessed")
+
+    def __init__(self):
+        self.history = []
+        self.loaded = False  # False while only locally appended messages are known
+        self.loaded_at = 0.0
+        self.pending = []
+        self.flushing = []  # batch currently being written by the flusher
+        self.flushed = 0  # batches written so far, to notice a flush finishing during a store read
+        self.dirty_since = None
+        self.accessed = time.monotonic()
+
+
+class HistoryCache:
+    def __init__(self, store, max_entries=HISTORY_CACHE_SIZE, ttl=HISTORY_CACHE_TTL,
+                 flush_interval=HISTORY_FLUSH_INTERVAL, flush_workers=HISTORY_FLUSH_WORKERS,
+                 on_flush_error=None):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.on_flush_error = on_flush_error
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._flusher = None
+        # Threads are only started on first use, so they belong to the worker process
+        self._flush_pool = ThreadPoolExecutor(max_workers=flush_workers, thread_name_prefix="history-flush")
+        self._hits = 0
+        self._misses = 0
+        self._flushes = 0
+        self._flush_errors = 0
+        self._flushed_messages = 0
+        self._flush_seconds_total = 0.0
+        self._flush_seconds_max = 0.0
+
+    # Reads
+    def load(self, user_id):
+        """Return a copy of the user's history, reading the store only on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.loaded and now - entry.loaded_at <= self.ttl:
+                self._hits += 1
+                entry.accessed = now
+                self._entries.move_to_end(user_id)
+                return list(entry.history)
+            self._misses += 1
+
+        # Unflushed messages are always newer than anything in the store, but a
+        # batch being flushed right now may already be in both; drop duplicates.
+        # A batch that finishes flushing while the store is read is no longer
+        # queued afterwards and may be missing from what was read: the store is
+        # read again, and the local messages from before the read are kept too
+        # (matched by identity) in case flushes keep finishing.
+        for attempt in range(3):
+            with self._lock:
+                entry = self._entries.get(user_id)
+                before = self._local_messages(entry)
+                flushed = entry.flushed if entry else 0
+            stored = self.store.load(user_id)
+            with self._lock:
+                entry = self._entries.get(user_id)
+                if attempt < 2 and entry is not None and entry.flushed != flushed:
+                    continue
+                entry = entry or _Entry()
+                seen = {id(m) for m in before}
+                local = before + [m for m in self._local_messages(entry) if id(m) not in seen]
+                entry.history = stored + [m for m in local if m not in stored]
+                entry.history = entry.history[-self.store.max_messages:]
+                entry.loaded = True
+                entry.loaded_at = entry.accessed = time.monotonic()
+                self._entries[user_id] = entry
+                self._entries.move_to_end(user_id)
+                self._evict()
+                return list(entry.history)
+
+    @staticmethod
+    def _local_messages(entry):
+        """Messages of entry that the store may not have yet"""
+        if entry is None:
+            return []
+        return list(entry.history) if not entry.loaded else entry.flushing + entry.pending
+
+    # Writes
+    def append(self, user_id, messages):
+        """Add messages to the cached history and queue them for the next flush"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                entry = self._entries[user_id] = _Entry()
+            entry.history.extend(messages)
+            del entry.history[:-self.store.max_messages]
+            entry.pending.extend(messages)
+            if entry.dirty_since is None:
+                entry.dirty_since = time.monotonic()
+            entry.accessed = time.monotonic()
+            self._entries.move_to_end(user_id)
+            self._evict()
+        self._ensure_flusher()
+
+    # Flushing
+    def _ensure_flusher(self):
+        # Started lazily so the thread belongs to the worker process, not the gunicorn master
+        if self._stopped:
+            # After drain() there is no flusher left, write through instead
+            self.flush(force=True)
+            return
+        if self._flusher is None or not self._flusher.is_alive():
+            with self._lock:
+                if self._flusher is None or not self._flusher.is_alive():
+                    self._flusher = threading.Thread(target=self._run, name="history-flusher", daemon=True)
+                    self._flusher.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.flush_interval / 2)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self, force=False):
+        """Write out every queued batch that has been dirty for flush_interval (or all when forced)"""
+        now = time.monotonic()
+        with self._lock:
+            due = [
+                user_id for user_id, entry in self._entries.items()
+                if entry.pending and (force or now - entry.dirty_since >= self.flush_interval)
+            ]
+        if len(due) == 1:
+            self._flush_user(due[0])
+        elif due:
+            list(self._flush_pool.map(self._flush_user, due))
+
+    def _flush_user(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or not entry.pending:
+                return
+            batch, entry.pending, entry.dirty_since = entry.pending, [], None
+            entry.flushing = batch
+            # A history read through load() has been migrated already
+            migrated = entry.loaded
+
+        started = time.perf_counter()
+        try:
+            self.store.append(user_id, batch, migrated=migrated)
+        except Exception as e:
+            # append() raises only when the batch is not in the manifest (failures of the
+            # compaction that may follow are its own business), so retrying cannot store it twice
+            with self._lock:
+                self._flush_errors += 1
+                # Requeue ahead of anything appended meanwhile and retry next round
+                entry.flushing = []
+                entry.pending = batch + entry.pending
+                entry.dirty_since = time.monotonic()
+                if user_id not in self._entries:
+                    self._entries[user_id] = entry
+            if self.on_flush_error:
+                self.on_flush_error(e)
+            return
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            entry.flushing = []
+            entry.flushed += 1
+            self._flushes += 1
+            self._flushed_messages += len(batch)
+            self._flush_seconds_total += elapsed
+            self._flush_seconds_max = max(self._flush_seconds_max, elapsed)
+
+    def drain(self):
+        """Stop the background flusher and synchronously write all pending messages"""
+        self._stopped = True
+        self._wake.set()
+        if self._flusher is not None and self._flusher is not threading.current_thread():
+            self._flusher.join(timeout=self.flush_interval + 5)
+        self.flush(force=True)
+
+    # Eviction
+    def _evict(self):
+        # Entries are kept in access order, so expired ones are all at the front
+        now = time.monotonic()
+        over = len(self._entries) - self.max_entries
+        victims = []
+        for user_id, entry in self._entries.items():
+            if over <= 0 and now - entry.accessed <= self.ttl:
+                break
+            if entry.pending or entry.flushing:
+                continue  # dirty entries stay until the flusher has written them out
+            victims.append(user_id)
+            over -= 1
+        for user_id in victims:
+            del self._entries[user_id]
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "dirty_entries": sum(1 for e in self._entries.values() if e.pending),
+                "pending_messages": sum(len(e.pending) for e in self._entries.values()),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "flushes": self._flushes,
+                "flush_errors": self._flush_errors,
+                "flushed_messages": self._flushed_messages,
+                "flush_latency_avg": self._flush_seconds_total / self._flushes if self._flushes else 0.0,
+                "flush_latency_max": self._flush_seconds_max
+            }
@@ -0,0 +1,113 @@
+"""Compact, versioned encoding for stored chat history messages
+
+Layouts (the JSON inside the object):
+
+- rows, version 1: a plain JSON list of message objects, the original format
+- columns, version 2: ``{"v": 2, "n": count, "cols": {key: [values...]}}``;
+  every key is stored once instead of once per message. Keys a message does
+  not have are stored as ``null`` and left out again when decoding.
+
+The JSON is optionally compressed with gzip or zstd (the ``zstandard``
+package, if installed). ``decode`` detects compression from the magic bytes
+and the layout from the JSON shape, so objects in any format, including old
+uncompressed ones, can always be read; ``HISTORY_ENCODING`` and
+``HISTORY_LAYOUT`` only choose what new objects are written as.
+"""
+import os, json, gzip, logging
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+HISTORY_ENCODING = os.getenv("HISTORY_ENCODING", "gzip")  # json, gzip or zstd
+HISTORY_LAYOUT = os.getenv("HISTORY_LAYOUT", "columns")  # rows or columns
+HISTORY_COMPRESS_LEVEL = int(os.getenv("HISTORY_COMPRESS_LEVEL", "6"))
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COLUMNS_VERSION = 2
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "gzip": "application/gzip",
+    "zstd": "application/zstd"
+}
+
+log = logging.getLogger(__name__)
+
+
+def to_columns(messages):
+    keys = {}
+    for message in messages:
+        for key in message:
+            keys.setdefault(key, None)  # first-seen order
+    return {
+        "v": COLUMNS_VERSION,
+        "n": len(messages),
+        "cols": {key: [message.get(key) for message in messages] for key in keys}
+    }
+
+
+def from_columns(data):
+    cols = data["cols"]
+    keys = list(cols)
+    return [
+        {key: value for key, value in zip(keys, values) if value is not None}
+        for values in zip(*(cols[key] for key in keys))
+    ] if keys else [{} for _ in range(data.get("n", 0))]
+
+
+class HistoryCodec:
+    def __init__(self, encoding=HISTORY_ENCODING, layout=HISTORY_LAYOUT, level=HISTORY_COMPRESS_LEVEL):
+        if encoding == "zstd" and zstandard is None:
+            log.warning("HISTORY_ENCODING=zstd but the zstandard package is not installed, using gzip")
+            encoding = "gzip"
+        if encoding not in CONTENT_TYPES:
+            raise ValueError(f"unknown history encoding: {encoding}")
+        if layout not in ("rows", "columns"):
+            raise ValueError(f"unknown history layout: {layout}")
+        self.encoding = encoding
+        self.layout = layout
+        self.level = level
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES[self.encoding]
+
+    @property
+    def format(self):
+        return f"{self.encoding}/{self.layout}"
+
+    def encode(self, messages):
+        """Serialize a list of messages to bytes in the configured format"""
+        value = to_columns(messages) if self.layout == "columns" else messages
+        raw = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if self.encoding == "gzip":
+            # mtime=0 keeps the output deterministic for identical input
+            return gzip.compress(raw, compresslevel=self.level, mtime=0)
+        if self.encoding == "zstd":
+            return zstandard.ZstdCompressor(level=self.level).compress(raw)
+        return raw
+
+    @staticmethod
+    def decode(body):
+        """Parse bytes written in any supported format back into a list of messages"""
+        return HistoryCodec.decode_with_format(body)[0]
+
+    @staticmethod
+    def decode_with_format(body):
+        """Like ``decode``, also returning the detected format, e.g. ``"gzip/columns"``"""
+        encoding = "json"
+        if body[:2] == GZIP_MAGIC:
+            encoding, body = "gzip", gzip.decompress(body)
+        elif body[:4] == ZSTD_MAGIC:
+            if zstandard is None:
+                raise RuntimeError("history object is zstd-compressed but zstandard is not installed")
+            encoding, body = "zstd", zstandard.ZstdDecompressor().decompress(body)
+        value = json.loads(body)
+        if isinstance(value, dict):
+            if value.get("v") != COLUMNS_VERSION:
+                raise ValueError(f"unsupported history format version: {value.get('v')}")
+            return from_columns(value), f"{encoding}/columns"
+        return value, f"{encoding}/rows"
@@ -0,0 +1,234 @@
+"""Bulk scan (and optional rewrite) of every history under ``chat_history/``
+
+    flask --app app history-scan [--workers 16] [--checkpoint scan.json]
+                                 [--rewrite [--dry-run]] [--output stats.json]
+
+Users are listed a page at a time with ``ListObjectsV2`` using ``/`` as the
+delimiter, so each user shows up once, either as a legacy
+``chat_history/{user_id}.json`` object or as a ``chat_history/{user_id}/``
+prefix, and the segment objects themselves are never listed. The histories of
+a page are read in parallel on a bounded thread pool with
+``HistoryStore.inspect``, which never migrates or writes anything.
+
+The aggregate stats (messages per character, a histogram of history sizes,
+storage formats, chats without a reply and messages without a chatId) are
+printed to stderr as the scan goes and written as JSON at the end. With
+``--checkpoint`` the stats and the position after every completed page are
+saved to a file, and running the same command again continues from there.
+
+``--rewrite`` migrates legacy histories and compacts those that have several
+segments or a segment not in the current ``HistoryCodec`` format; with
+``--dry-run`` it only counts what would be rewritten.
+"""
+import os, json, time, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from history_store import HistoryStore, HISTORY_PREFIX
+from storage import S3_BUCKET
+
+HISTORY_SCAN_PAGE_SIZE = int(os.getenv("HISTORY_SCAN_PAGE_SIZE", "1000"))
+
+# Upper bounds (in messages) of the history size histogram buckets
+SIZE_BUCKETS = (0, 10, 50, 100, 500)
+MAX_SAMPLES = 100  # orphaned chats / errors listed by id in the output
+
+
+def size_bucket(count):
+    lower = 0
+    for upper in SIZE_BUCKETS:
+        if count <= upper:
+            return f"{lower}-{upper}" if upper else "0"
+        lower = upper + 1
+    return f"{lower}+"
+
+
+def new_stats():
+    return {
+        "users": 0,
+        "legacy_users": 0,
+        "messages": 0,
+        "segments": 0,
+        "bytes": 0,
+        "messages_by_character": {},
+        "history_sizes": {},
+        "formats": {},
+        "orphaned_chats": 0,
+        "orphaned_chat_samples": [],
+        "messages_without_chat": 0,
+        "rewrites": 0,
+        "errors": 0,
+        "error_samples": []
+    }
+
+
+def bump(counts, key, by=1):
+    counts[key] = counts.get(key, 0) + by
+
+
+def add_sample(samples, value):
+    if len(samples) < MAX_SAMPLES:
+        samples.append(value)
+
+
+def needs_rewrite(info, codec):
+    return info["legacy"] or info["segments"] > 1 or any(fmt != codec.format for fmt in info["formats"])
+
+
+def user_ids(page):
+    """User ids in one ListObjectsV2 page, in key order"""
+    prefix = HISTORY_PREFIX + "/"
+    names = [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+    names += [o["Key"] for o in page.get("Contents", []) if o["Key"].endswith(".json")]
+    ids = []
+    for name in sorted(names):
+        user_id = name[len(prefix):].rstrip("/")
+        if user_id.endswith(".json"):
+            user_id = user_id[:-len(".json")]
+        if user_id and (not ids or ids[-1] != user_id):
+            ids.append(user_id)
+    return ids
+
+
+def resume_key(user_id):
+    """StartAfter value that skips both of a user's keys: ``{id}.json`` and everything under ``{id}/``"""
+    # "0" sorts right after "/", so no other user id falls in between
+    return f"{HISTORY_PREFIX}/{user_id}0"
+
+
+class HistoryScanner:
+    def __init__(self, store, workers=16, rewrite=False, dry_run=False, page_size=HISTORY_SCAN_PAGE_SIZE):
+        self.store = store
+        self.workers = workers
+        self.rewrite = rewrite
+        self.dry_run = dry_run
+        self.page_size = page_size
+        self.stats = new_stats()
+        self._lock = threading.Lock()
+
+    def scan_user(self, user_id):
+        """Inspect (and maybe rewrite) one user's history, folding the result into the stats"""
+        try:
+            info = self.store.inspect(user_id)
+            if info is None:
+                return
+            rewrite = self.rewrite and needs_rewrite(info, self.store.codec)
+            if rewrite and not self.dry_run:
+                if info["legacy"]:
+                    self.store.migrate(user_id)
+                else:
+                    self.store.compact(user_id, force=True)
+        except Exception as e:
+            with self._lock:
+                self.stats["errors"] += 1
+                add_sample(self.stats["error_samples"], f"{user_id}: {e}")
+            return
+
+        chats = {}  # chatId -> roles seen
+        by_character = {}
+        without_chat = 0
+        for msg in info["messages"]:
+            role = msg.get("role", msg.get("type"))
+            if role in ("assistant", "ai"):
+                bump(by_character, msg.get("character") or "Unknown")
+            chat_id = msg.get("chatId")
+            if chat_id:
+                chats.setdefault(chat_id, set()).add("assistant" if role in ("assistant", "ai") else "user")
+            else:
+                without_chat += 1
+        orphaned = [chat_id for chat_id, roles in chats.items() if "assistant" not in roles]
+
+        with self._lock:
+            stats = self.stats
+            stats["users"] += 1
+            stats["legacy_users"] += info["legacy"]
+            stats["messages"] += len(info["messages"])
+            stats["segments"] += info["segments"]
+            stats["bytes"] += info["bytes"]
+            for character, count in by_character.items():
+                bump(stats["messages_by_character"], character, count)
+            bump(stats["history_sizes"], size_bucket(len(info["messages"])))
+            for fmt, count in info["formats"].items():
+                bump(stats["formats"], fmt, count)
+            stats["orphaned_chats"] += len(orphaned)
+            for chat_id in orphaned:
+                add_sample(stats["orphaned_chat_samples"], f"{user_id}/{chat_id}")
+            stats["messages_without_chat"] += without_chat
+            stats["rewrites"] += rewrite
+
+    def pages(self, start_after=""):
+        """Yield the user ids of each listing page along with the position after it"""
+        paginator = self.store.s3.get_paginator("list_objects_v2")
+        params = {
+            "Bucket": self.store.bucket,
+            "Prefix": HISTORY_PREFIX + "/",
+            "Delimiter": "/",
+            "PaginationConfig": {"PageSize": self.page_size}
+        }
+        if start_after:
+            params["StartAfter"] = start_after
+        last_user = None
+        for page in paginator.paginate(**params):
+            ids = user_ids(page)
+            # A user whose legacy object and prefix straddle two pages is scanned once
+            if ids and ids[0] == last_user:
+                ids = ids[1:]
+            if ids:
+                last_user = ids[-1]
+                yield ids, resume_key(last_user)
+
+    def run(self, start_after="", on_page=None):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="history-scan") as pool:
+            for ids, position in self.pages(start_after):
+                list(pool.map(self.scan_user, ids))
+                if on_page:
+                    on_page(position)
+        return self.stats
+
+
+def load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path, position, stats):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"after": position, "stats": stats}, f)
+    os.replace(tmp, path)
+
+
+@click.command("history-scan")
+@click.option("--workers", default=16, show_default=True, help="Histories read in parallel.")
+@click.option("--checkpoint", type=click.Path(dir_okay=False), help="Save progress here and resume from it.")
+@click.option("--rewrite", is_flag=True, help="Migrate legacy histories and compact/re-encode stale ones.")
+@click.option("--dry-run", is_flag=True, help="With --rewrite, only count what would be rewritten.")
+@click.option("--output", type=click.File("w"), default="-", help="Where to write the final stats (JSON).")
+def history_scan_command(workers, checkpoint, rewrite, dry_run, output):
+    """Scan every chat history in the bucket and report aggregate stats."""
+    if not S3_BUCKET:
+        raise click.ClickException("S3_BUCKET is not set")
+    scanner = HistoryScanner(HistoryStore(S3_BUCKET), workers=workers, rewrite=rewrite, dry_run=dry_run)
+    start_after = ""
+    saved = load_checkpoint(checkpoint) if checkpoint else None
+    if saved:
+        start_after, scanner.stats = saved["after"], saved["stats"]
+        click.echo(f"Resuming after {start_after} ({scanner.stats['users']} users already scanned)", err=True)
+
+    started = time.monotonic()
+    def on_page(position):
+        if checkpoint:
+            save_checkpoint(checkpoint, position, scanner.stats)
+        stats = scanner.stats
+        click.echo(f"{stats['users']} users, {stats['messages']} messages, {stats['rewrites']} rewrites, "
+                   f"{stats['errors']} errors ({time.monotonic() - started:.1f}s)", err=True)
+
+    stats = scanner.run(start_after, on_page=on_page)
+    json.dump(stats, output, indent=2, sort_keys=True)
+    output.write("\n")
+    if stats["errors"]:
+        raise SystemExit(1)
@@ -0,0 +1,352 @@
+"""Append-only, segmented chat history storage on S3
+
+Each user's history lives under ``chat_history/{user_id}/``:
+
+- ``manifest.json`` lists the segment objects in append order
+- ``segments/<name>.json`` holds the messages of one or more turns
+
+Appending a turn writes one small segment and rewrites the manifest, so the
+bytes written per message do not depend on how long the history is. Once the
+manifest lists more than ``compact_segments`` segments they are merged into a
+single base segment (trimmed to ``max_messages``). Histories stored in the old
+single-object format (``chat_history/{user_id}.json``) are migrated on read.
+
+Segment objects are written with ``HistoryCodec`` (gzip-compressed, columnar
+JSON by default); any supported format, including plain JSON, is detected
+when reading. The manifest stays plain JSON.
+
+Segments are never overwritten, so the manifest is the only object writers
+contend on. It is written with an ETag-conditional put (``If-Match``, or
+``If-None-Match: *`` when creating it); if another worker changed it in the
+meantime the put fails, the manifest is re-read and the change is applied to
+the fresh copy and retried. Within a process writes for the same user are also
+serialized by a per-user lock, so conditional puts only race across workers.
+
+Compaction and the removal of replaced objects are best-effort: once a turn is
+in the manifest, ``append`` returns normally even if merging or deleting
+fails (another worker compacted first, or the credentials lack
+``s3:DeleteObject``); leftover objects are only wasted space.
+"""
+import os, json, time, uuid, random, logging, threading, weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError, BotoCoreError
+
+from history_codec import HistoryCodec
+from metrics import counter
+from storage import get_s3_client
+
+HISTORY_PREFIX = "chat_history"
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "500"))
+HISTORY_COMPACT_SEGMENTS = int(os.getenv("HISTORY_COMPACT_SEGMENTS", "32"))
+HISTORY_WRITE_RETRIES = int(os.getenv("HISTORY_WRITE_RETRIES", "8"))
+MANIFEST_VERSION = 1
+
+HISTORY_WRITE_CONFLICTS = counter("history_write_conflicts_total",
+                                  "Conditional manifest writes that lost a race and were retried")
+
+log = logging.getLogger(__name__)
+
+# Segment GETs are independent, fetch them in parallel
+_segment_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="history-segments")
+
+
+def is_missing(error):
+    return error.response["Error"].get("Code", "") in ("NoSuchKey", "404")
+
+
+def is_conflict(error):
+    # 412: the ETag no longer matches, 409: a concurrent conditional write is in progress
+    return error.response["Error"].get("Code", "") in ("PreconditionFailed", "412",
+                                                        "ConditionalRequestConflict", "409")
+
+
+class WriteConflict(Exception):
+    """The manifest kept changing underneath us for every retry"""
+
+
+class HistoryStore:
+    def __init__(self, bucket, s3_client=None, max_messages=HISTORY_MAX_MESSAGES,
+                 compact_segments=HISTORY_COMPACT_SEGMENTS, write_retries=HISTORY_WRITE_RETRIES,
+                 codec=None):
+        self.bucket = bucket
+        self._s3 = s3_client
+        self.codec = codec or HistoryCodec()
+        self.max_messages = max_messages
+        self.compact_segments = compact_segments
+        self.write_retries = write_retries
+        self._user_locks = weakref.WeakValueDictionary()
+        self._user_locks_guard = threading.Lock()
+
+    @property
+    def s3(self):
+        # Resolved on use so no client is created at import time
+        return self._s3 or get_s3_client()
+
+    # Keys
+    def legacy_key(self, user_id):
+        return f"{HISTORY_PREFIX}/{user_id}.json"
+
+    def manifest_key(self, user_id):
+        return f"{HISTORY_PREFIX}/{user_id}/manifest.json"
+
+    def segment_key(self, user_id, name):
+        return f"{HISTORY_PREFIX}/{user_id}/segments/{name}"
+
+    @staticmethod
+    def new_segment_name():
+        # Zero-padded nanosecond prefix keeps names in chronological order
+        return f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json"
+
+    def user_lock(self, user_id):
+        """Lock serializing this process's writes for one user; other users never share it"""
+        with self._user_locks_guard:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                # Held weakly, so the lock goes away once no writer is using it
+                lock = self._user_locks[user_id] = threading.RLock()
+            return lock
+
+    # Raw object access
+    def _get_messages(self, key):
+        response = self.s3.get_object(Bucket=self.bucket, Key=key)
+        return self.codec.decode(response["Body"].read())
+
+    def _put_messages(self, key, messages):
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=self.codec.encode(messages),
+            ContentType=self.codec.content_type
+        )
+
+    def _get_json_with_etag(self, key):
+        response = self.s3.get_object(Bucket=self.bucket, Key=key)
+        return json.loads(response["Body"].read().decode("utf-8")), response.get("ETag")
+
+    def _put_json(self, key, value, **conditions):
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=json.dumps(value, ensure_ascii=False),
+            ContentType="application/json",
+            **conditions
+        )
+
+    def _read_manifest(self, user_id):
+        """Return ``(manifest, etag)``, or ``(None, None)`` if there is no manifest yet"""
+        try:
+            return self._get_json_with_etag(self.manifest_key(user_id))
+        except ClientError as e:
+            if is_missing(e):
+                return None, None
+            raise
+
+    def _write_manifest(self, user_id, segments, count, etag):
+        """Write the manifest only if it is still at ``etag`` (None: only if it does not exist)"""
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "segments": segments,
+            "count": count,
+            "updated": time.time()
+        }
+        conditions = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            self._put_json(self.manifest_key(user_id), manifest, **conditions)
+        except ClientError as e:
+            # If-Match on a manifest deleted in the meantime fails with 404
+            if is_conflict(e) or (etag and is_missing(e)):
+                HISTORY_WRITE_CONFLICTS.inc()
+                raise WriteConflict(f"manifest for {user_id} changed concurrently") from e
+            raise
+        return manifest
+
+    def _update_manifest(self, user_id, update, current=None):
+        """Apply ``update(manifest) -> (segments, count)`` with optimistic concurrency
+
+        ``update`` receives the latest manifest (or None) and may return None
+        to give up. On a lost race the manifest is re-read and ``update`` is
+        called again, after a short randomized backoff.
+        """
+        for attempt in range(self.write_retries + 1):
+            manifest, etag = current or self._read_manifest(user_id)
+            current = None
+            change = update(manifest)
+            if change is None:
+                return None
+            try:
+                return self._write_manifest(user_id, *change, etag=etag)
+            except WriteConflict:
+                if attempt == self.write_retries:
+                    raise
+                time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+    def _write_segment(self, user_id, messages):
+        name = self.new_segment_name()
+        self._put_messages(self.segment_key(user_id, name), messages)
+        return name
+
+    def _read_segments(self, user_id, names):
+        keys = [self.segment_key(user_id, name) for name in names]
+        messages = []
+        for segment in _segment_pool.map(self._get_messages, keys):
+            messages.extend(segment)
+        return messages
+
+    def _delete_segments(self, user_id, names):
+        """Remove segments no manifest refers to any more; failures are logged, not raised"""
+        keys = [{"Key": self.segment_key(user_id, name)} for name in names]
+        # delete_objects accepts at most 1000 keys per call
+        for i in range(0, len(keys), 1000):
+            batch = keys[i:i + 1000]
+            try:
+                response = self.s3.delete_objects(Bucket=self.bucket, Delete={"Objects": batch, "Quiet": True})
+            except (ClientError, BotoCoreError) as e:
+                log.warning("Could not delete %d replaced history segments of %s: %s", len(batch), user_id, e)
+                continue
+            # Per-key failures (e.g. AccessDenied without s3:DeleteObject) come back in the body
+            errors = response.get("Errors", [])
+            if errors:
+                log.warning("Could not delete %d replaced history segments of %s: %s",
+                            len(errors), user_id, errors[0].get("Code"))
+
+    # Public API
+    def load(self, user_id):
+        """Return the user's history (oldest first), migrating a legacy object if needed"""
+        for attempt in range(self.write_retries + 1):
+            manifest, _ = self._read_manifest(user_id)
+            if manifest is None:
+                return self.migrate(user_id)
+            try:
+                return self._read_segments(user_id, manifest["segments"])[-self.max_messages:]
+            except ClientError as e:
+                # A concurrent compaction deleted segments of the manifest we read
+                if not is_missing(e) or attempt == self.write_retries:
+                    raise
+
+    def append(self, user_id, messages, migrated=False):
+        """Persist new messages as their own segment and register it in the manifest
+
+        With ``migrated`` the caller has loaded this history before (which
+        migrates it), so a missing manifest means a new user and the legacy
+        object is not looked up. Raises only if the messages were not stored,
+        so the caller can safely write them again.
+        """
+        with self.user_lock(user_id):
+            manifest, etag = self._read_manifest(user_id)
+            # Only a migration that found a legacy object wrote a manifest worth re-reading
+            if manifest is None and not migrated and self.migrate(user_id):
+                manifest, etag = self._read_manifest(user_id)
+
+            name = self._write_segment(user_id, messages)
+
+            def add_segment(manifest):
+                manifest = manifest or {"segments": [], "count": 0}
+                return manifest["segments"] + [name], manifest.get("count", 0) + len(messages)
+
+            manifest = self._update_manifest(user_id, add_segment, current=(manifest, etag))
+            # The turn is stored now; a failed compaction must not make the caller write it again
+            if len(manifest["segments"]) > self.compact_segments:
+                try:
+                    self.compact(user_id)
+                except Exception as e:
+                    log.warning("Compacting the history of %s failed: %s", user_id, e)
+
+    def save(self, user_id, history):
+        """Replace the whole history with a single base segment"""
+        with self.user_lock(user_id):
+            history = history[-self.max_messages:]
+            name = self._write_segment(user_id, history)
+            replaced = []
+
+            def replace(manifest):
+                replaced[:] = manifest["segments"] if manifest else []
+                return [name], len(history)
+
+            self._update_manifest(user_id, replace)
+            if replaced:
+                self._delete_segments(user_id, replaced)
+
+    def compact(self, user_id, force=False):
+        """Merge all segments into one base segment trimmed to max_messages
+
+        With ``force`` a single segment is rewritten too, e.g. to re-encode it
+        in the current format.
+        """
+        with self.user_lock(user_id):
+            manifest, etag = self._read_manifest(user_id)
+            if not manifest or not manifest["segments"] or (len(manifest["segments"]) <= 1 and not force):
+                return
+            merged = manifest["segments"]
+            try:
+                history = self._read_segments(user_id, merged)[-self.max_messages:]
+            except ClientError as e:
+                if is_missing(e):
+                    return  # another worker compacted these segments in the meantime
+                raise
+            name = self._write_segment(user_id, history)
+
+            def replace_merged(current):
+                # Segments appended since we read are kept after the new base segment
+                if not current or current["segments"][:len(merged)] != merged:
+                    return None  # compacted or replaced by another worker
+                added = current.get("count", 0) - manifest.get("count", 0)
+                return [name] + current["segments"][len(merged):], len(history) + added
+
+            if self._update_manifest(user_id, replace_merged, current=(manifest, etag)) is None:
+                self._delete_segments(user_id, [name])
+                return
+            self._delete_segments(user_id, merged)
+
+    def inspect(self, user_id):
+        """Read a history without migrating or writing anything, with details on how it is stored
+
+        Returns None if the user has no history at all.
+        """
+        manifest, _ = self._read_manifest(user_id)
+        legacy = manifest is None
+        keys = [self.legacy_key(user_id)] if legacy else \
+            [self.segment_key(user_id, name) for name in manifest["segments"]]
+        messages, formats, size = [], {}, 0
+        for key in keys:
+            try:
+                body = self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+            except ClientError as e:
+                if legacy and is_missing(e):
+                    return None
+                raise
+            segment, fmt = self.codec.decode_with_format(body)
+            messages.extend(segment)
+            formats[fmt] = formats.get(fmt, 0) + 1
+            size += len(body)
+        return {
+            "legacy": legacy,
+            "segments": 0 if legacy else len(keys),
+            "formats": formats,
+            "bytes": size,
+            "messages": messages
+        }
+
+    def migrate(self, user_id):
+        """Convert a legacy single-object history into the segmented format"""
+        with self.user_lock(user_id):
+            try:
+                history = self._get_messages(self.legacy_key(user_id))
+            except ClientError as e:
+                if is_missing(e):
+                    return []
+                raise
+            history = history[-self.max_messages:]
+            name = self._write_segment(user_id, history)
+            try:
+                self._write_manifest(user_id, [name], len(history), etag=None)
+            except WriteConflict:
+                # Another worker migrated first; its copy is the one in the manifest
+                self._delete_segments(user_id, [name])
+                return self.load(user_id)
+            try:
+                self.s3.delete_object(Bucket=self.bucket, Key=self.legacy_key(user_id))
+            except (ClientError, BotoCoreError) as e:
+                # The manifest takes precedence, a leftover legacy object is never read again
+                log.warning("Could not delete the migrated legacy history of %s: %s", user_id, e)
+            return history
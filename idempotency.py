@@ -0,0 +1,129 @@
+"""Single-flight deduplication of chat submissions
+
+Identical requests (a double click, a client retrying after a timeout) are
+collapsed onto one upstream call and one history append:
+
+- With an ``Idempotency-Key`` header the key is (user, header value). The
+  result is kept for ``ttl`` seconds, and reusing the key for a different
+  message is an error (``IdempotencyMismatch``).
+- Without one, requests are keyed on (user, chatId, character, message) and a
+  finished result is kept only for ``dedupe_window`` seconds, so sending the
+  same short message again later still gets a fresh reply.
+
+A duplicate that arrives while the first request is still running waits for
+its result. Only successful results are kept once the first request is done;
+if it produced none (an admission error, a throttled upstream, a dropped
+stream) the duplicates go on to answer themselves. State is per worker.
+"""
+import os, time, hashlib, threading
+from collections import OrderedDict
+
+from metrics import counter
+
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "300"))
+IDEMPOTENCY_DEDUPE_WINDOW = float(os.getenv("IDEMPOTENCY_DEDUPE_WINDOW", "5"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "120"))
+
+DEDUPLICATED = counter("chat_deduplicated_total", "Chat requests answered with another request's result", ["state"])
+
+
+class IdempotencyMismatch(Exception):
+    """An Idempotency-Key was reused for a different request"""
+
+
+class _Flight:
+    __slots__ = ("fingerprint", "done", "result", "keep_until")
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.result = None
+        self.keep_until = None  # set once finished
+
+
+class SingleFlight:
+    def __init__(self, ttl=IDEMPOTENCY_TTL, dedupe_window=IDEMPOTENCY_DEDUPE_WINDOW,
+                 max_entries=IDEMPOTENCY_MAX_ENTRIES, wait_timeout=IDEMPOTENCY_WAIT_TIMEOUT):
+        self.ttl = ttl
+        self.dedupe_window = dedupe_window
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self._flights = OrderedDict()  # key -> _Flight
+        self._lock = threading.Lock()
+        self._pruned = 0.0
+
+    @staticmethod
+    def key(user_id, chat_id, character, message, idempotency_key=None):
+        """(key, fingerprint) for a chat submission"""
+        fingerprint = hashlib.sha256(f"{chat_id}\0{character}\0{message}".encode("utf-8")).hexdigest()
+        if idempotency_key:
+            return ("key", user_id, idempotency_key), fingerprint
+        return ("auto", user_id, fingerprint), fingerprint
+
+    def _prune(self, now):
+        if now - self._pruned < 1.0 and len(self._flights) <= self.max_entries:
+            return
+        self._pruned = now
+        for key in [k for k, f in self._flights.items() if f.keep_until is not None and f.keep_until <= now]:
+            del self._flights[key]
+        # Only finished entries are dropped for space, a running one must stay findable
+        for key in [k for k, f in self._flights.items() if f.keep_until is not None]:
+            if len(self._flights) <= self.max_entries:
+                break
+            del self._flights[key]
+
+    def join(self, key, fingerprint):
+        """Return ``(flight, None)`` or ``(None, result)`` for a request
+
+        With a flight the caller is the first such request and must ``finish``
+        or ``fail`` it; otherwise result is the first request's result.
+        ``(None, None)`` means that request did not finish within
+        ``wait_timeout``, so the caller answers on its own.
+        """
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                self._prune(now)
+                flight = self._flights.get(key)
+                if flight is not None and flight.fingerprint != fingerprint:
+                    raise IdempotencyMismatch("Idempotency-Key was already used for a different request")
+                if flight is None:
+                    flight = self._flights[key] = _Flight(fingerprint)
+                    return flight, None
+            finished = flight.done.is_set()
+            if not flight.done.wait(self.wait_timeout):
+                return None, None
+            if flight.result is not None:
+                DEDUPLICATED.inc(state="finished" if finished else "in_flight")
+                return None, flight.result
+            # The first request failed; the next one in takes over
+
+    def finish(self, key, flight, result, keep=True):
+        """Hand result to the waiting duplicates; with ``keep`` later ones get it too for a while"""
+        if flight is None:
+            return
+        window = self.ttl if key[0] == "key" else self.dedupe_window
+        with self._lock:
+            if keep:
+                flight.keep_until = time.monotonic() + window
+            elif self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.result = result
+        flight.done.set()
+
+    def fail(self, key, flight):
+        """The request produced no shareable result; waiting duplicates answer themselves"""
+        if flight is None or flight.done.is_set():
+            return
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._flights),
+                "in_flight": sum(1 for f in self._flights.values() if f.keep_until is None)
+            }
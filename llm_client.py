@@ -0,0 +1,136 @@
+"""Shared, pooled HTTP client for the upstream LLM API
+
+Calls are admitted through a ``ConcurrencyLimiter`` (bounded in-flight calls
+and wait queue). Throttled or failed upstream responses (429/502/503/504 and
+connection errors) are retried with jittered exponential backoff; a
+``Retry-After`` header is honored as long as it is not longer than
+``LLM_RETRY_MAX_DELAY``, otherwise the response is handed to the caller.
+The slot is released while waiting so a throttled upstream does not hold up
+the whole queue.
+"""
+import os, random, threading, time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from admission import ConcurrencyLimiter
+from metrics import LLM_REQUEST_SECONDS, LLM_RESPONSES, counter, upstream_status_label
+
+# Connection pool / concurrency configuration
+LLM_POOL_CONNECTIONS = int(os.getenv("LLM_POOL_CONNECTIONS", "4"))  # number of distinct hosts kept pooled
+LLM_POOL_MAXSIZE = int(os.getenv("LLM_POOL_MAXSIZE", "32"))  # keep-alive connections kept per host
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "32"))  # concurrent upstream calls per worker
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "30"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+LLM_RETRIES_TOTAL = counter("llm_retries_total", "Upstream LLM calls retried, by cause", ["reason"])
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a ``Retry-After`` header (delta-seconds or HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class UpstreamClient:
+    """Keep-alive session shared by all requests in a worker, with a global in-flight limit"""
+
+    def __init__(self, pool_connections=LLM_POOL_CONNECTIONS, pool_maxsize=LLM_POOL_MAXSIZE,
+                 max_in_flight=LLM_MAX_IN_FLIGHT, connect_timeout=LLM_CONNECT_TIMEOUT,
+                 read_timeout=LLM_READ_TIMEOUT, retries=LLM_RETRIES,
+                 retry_base_delay=LLM_RETRY_BASE_DELAY, retry_max_delay=LLM_RETRY_MAX_DELAY):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.limiter = ConcurrencyLimiter(max_in_flight)
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Created on first use so every forked worker gets its own sockets
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                          pool_maxsize=self.pool_maxsize)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def backoff(self, attempt):
+        """Jittered exponential delay before retry number ``attempt + 1``"""
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def retry_delay(self, resp, attempt, retries):
+        """Seconds to wait before retrying ``resp``, or None to hand it to the caller"""
+        if resp.status_code not in RETRY_STATUSES or attempt >= retries:
+            return None
+        retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+        if retry_after is None:
+            return self.backoff(attempt)
+        if retry_after > self.retry_max_delay:
+            return None  # not worth holding the request that long
+        return retry_after + random.uniform(0, self.retry_base_delay)
+
+    @contextmanager
+    def post(self, url, retries=None, **kwargs):
+        """POST to the upstream, holding an in-flight slot until the response is closed
+
+        ``retries`` overrides the configured retry count, e.g. 0 when the
+        caller would rather fail over to another endpoint. Raises
+        ``admission.Overloaded`` if no slot frees up in time.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        retries = self.retries if retries is None else retries
+        stream = str(bool(kwargs.get("stream"))).lower()
+        for attempt in range(retries + 1):
+            with self.limiter.slot():
+                started = time.perf_counter()
+                try:
+                    resp = self.session.post(url, **kwargs)
+                except requests.exceptions.ConnectionError:
+                    LLM_RESPONSES.inc(status="error")
+                    if attempt >= retries:
+                        raise
+                    delay, reason = self.backoff(attempt), "connection"
+                except requests.exceptions.RequestException:
+                    LLM_RESPONSES.inc(status="error")
+                    raise
+                else:
+                    LLM_RESPONSES.inc(status=upstream_status_label(resp.status_code))
+                    delay, reason = self.retry_delay(resp, attempt, retries), str(resp.status_code)
+                    if delay is None:
+                        try:
+                            yield resp
+                        finally:
+                            resp.close()
+                            LLM_REQUEST_SECONDS.observe(time.perf_counter() - started, stream=stream)
+                        return
+                    resp.close()
+            LLM_RETRIES_TOTAL.inc(reason=reason)
+            time.sleep(delay)
+
+
+upstream = UpstreamClient()
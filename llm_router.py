@@ -0,0 +1,349 @@
+"""Latency-aware routing over a pool of OpenAI-compatible endpoints
+
+``LLM_ENDPOINTS`` is a JSON list of endpoints, for example::
+
+    [{"name": "chutes", "url": "https://llm.chutes.ai/v1/chat/completions",
+      "model": "deepseek-ai/DeepSeek-V3-0324", "api_key_env": "CHUTES_API_KEY"},
+     {"name": "backup", "url": "https://example.com/v1/chat/completions",
+      "model": "other-model", "api_key_env": "BACKUP_API_KEY"}]
+
+Without it the pool is the single ``CHUTES_BASE_URL`` / ``CHARACTER_MODEL``.
+
+Each request goes to the available endpoint with the lowest score: the
+exponentially weighted average latency (time to first token for streams,
+total time otherwise) scaled up by its recent error rate. A small fraction of
+requests is sent to a random endpoint so recovered endpoints get re-measured.
+After ``LLM_BREAKER_FAILURES`` consecutive failures an endpoint's circuit
+opens for ``LLM_BREAKER_COOLDOWN`` seconds, then a single trial request
+decides whether it closes again. Failed requests fail over to the next
+endpoint.
+
+With ``LLM_HEDGE_PERCENTILE`` set (e.g. 95), a stream that has not produced
+its first token within that percentile of the endpoint's recent times to first
+token gets a second, hedged request on another endpoint; whichever answers
+first is used and the other is cancelled.
+"""
+import os, json, math, queue, random, threading, time
+from collections import deque
+
+from admission import AdmissionError
+from llm_client import RETRY_STATUSES
+from metrics import LLM_TTFT_SECONDS, counter, record_usage
+
+LLM_ENDPOINTS = os.getenv("LLM_ENDPOINTS", "")
+LLM_ROUTER_EWMA_ALPHA = float(os.getenv("LLM_ROUTER_EWMA_ALPHA", "0.2"))
+LLM_ROUTER_EXPLORE = float(os.getenv("LLM_ROUTER_EXPLORE", "0.05"))
+LLM_ROUTER_ERROR_PENALTY = float(os.getenv("LLM_ROUTER_ERROR_PENALTY", "4"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))  # 0 disables hedging
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.25"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+LLM_HEDGES = counter("llm_hedged_requests_total", "Hedged second requests fired, by which one won", ["winner"])
+LLM_FAILOVERS = counter("llm_failovers_total", "Requests retried on another endpoint after a failure")
+
+
+def iter_deltas(resp):
+    """Yield content deltas from an OpenAI-compatible streaming completion"""
+    for line in resp.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        chunk = line[len("data:"):].strip()
+        if chunk == "[DONE]":
+            break
+        try:
+            event = json.loads(chunk)
+        except ValueError:
+            continue
+        record_usage(event.get("usage"))
+        choices = event.get("choices") or [{}]
+        delta = (choices[0].get("delta") or {}).get("content")
+        if delta:
+            yield delta
+
+
+class Endpoint:
+    def __init__(self, name, url, model, api_key=None):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.api_key = api_key
+        self.latency = {}  # stream flag -> EWMA seconds
+        self.error_rate = 0.0
+        self.failures = 0  # consecutive
+        self.open_until = 0.0
+        self.probing = False
+        self.ttfts = deque(maxlen=200)
+
+    def headers(self):
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def state(self, now):
+        if self.open_until <= 0:
+            return "closed"
+        return "open" if now < self.open_until or self.probing else "half_open"
+
+
+class _Attempt:
+    """One upstream request, run inline or on a helper thread when hedging"""
+
+    def __init__(self, router, endpoint, payload, stream, retries, done=None):
+        self.router = router
+        self.endpoint = endpoint
+        self.payload = {**payload, "model": endpoint.model}
+        self.stream = stream
+        self.retries = retries
+        self.done = done
+        self.resp = None
+        self.error = None
+        self.first = None
+        self.rest = iter(())
+        self._call = None
+        self._lock = threading.Lock()
+        self._finished = False
+        self._cancelled = False
+
+    @property
+    def failed(self):
+        return self.error is not None or self.resp.status_code in RETRY_STATUSES or self.resp.status_code >= 500
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            call = self.router.client.post(self.endpoint.url, retries=self.retries,
+                                           headers=self.endpoint.headers(), json=self.payload,
+                                           stream=self.stream)
+            self.resp = call.__enter__()
+            self._call = call
+            if self.stream and self.resp.status_code == 200:
+                # Wait for the first token so hedging and failover can act on it
+                self.rest = iter_deltas(self.resp)
+                self.first = next(self.rest, None)
+        except Exception as e:  # re-raised to the caller by LLMRouter.open()
+            self.error = e
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self._finished = True
+            cancelled = self._cancelled
+        if cancelled or isinstance(self.error, AdmissionError):
+            # Lost a hedge race or shed locally, neither is the endpoint's fault
+            self.close()
+            self.router.abandon(self.endpoint)
+        else:
+            if self.stream and self.first is not None:
+                LLM_TTFT_SECONDS.observe(elapsed)
+            self.router.record(self.endpoint, self.stream, elapsed, not self.failed)
+        if self.done is not None:
+            self.done.put(self)
+
+    def cancel(self):
+        """Abandon this attempt, closing it now or as soon as its thread finishes"""
+        # A read in progress cannot be interrupted safely from another thread
+        # (closing the response blocks on the reader's buffer lock), so a slow
+        # loser is closed by its own thread once its first token or timeout arrives
+        with self._lock:
+            self._cancelled = True
+            finished = self._finished
+        if finished:
+            self.close()
+
+    def close(self):
+        call, self._call = self._call, None
+        if call is not None:
+            call.__exit__(None, None, None)
+
+
+class UpstreamCall:
+    """The winning request: ``resp`` plus its content deltas when streaming"""
+
+    def __init__(self, attempt):
+        self._attempt = attempt
+        self.endpoint = attempt.endpoint
+        self.resp = attempt.resp
+
+    def deltas(self):
+        if self._attempt.first is not None:
+            yield self._attempt.first
+        yield from self._attempt.rest
+
+    def close(self):
+        self._attempt.close()
+
+
+class LLMRouter:
+    def __init__(self, endpoints, client, alpha=LLM_ROUTER_EWMA_ALPHA, explore=LLM_ROUTER_EXPLORE,
+                 error_penalty=LLM_ROUTER_ERROR_PENALTY, breaker_failures=LLM_BREAKER_FAILURES,
+                 breaker_cooldown=LLM_BREAKER_COOLDOWN, hedge_percentile=LLM_HEDGE_PERCENTILE,
+                 hedge_min_delay=LLM_HEDGE_MIN_DELAY, hedge_min_samples=LLM_HEDGE_MIN_SAMPLES):
+        if not endpoints:
+            raise ValueError("at least one LLM endpoint is required")
+        self.endpoints = endpoints
+        self.client = client
+        self.alpha = alpha
+        self.explore = explore
+        self.error_penalty = error_penalty
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, client, default_url, default_model, default_api_key=None):
+        """Build the pool from ``LLM_ENDPOINTS``, or a single default endpoint"""
+        if not LLM_ENDPOINTS:
+            return cls([Endpoint("default", default_url, default_model, default_api_key)], client)
+        endpoints = []
+        for i, spec in enumerate(json.loads(LLM_ENDPOINTS)):
+            api_key = os.getenv(spec["api_key_env"]) if spec.get("api_key_env") else default_api_key
+            endpoints.append(Endpoint(spec.get("name") or f"endpoint-{i}", spec.get("url", default_url),
+                                      spec.get("model", default_model), api_key))
+        return cls(endpoints, client)
+
+    # Routing state
+    def score(self, endpoint, stream):
+        latency = endpoint.latency.get(stream, endpoint.latency.get(not stream, 0.0))
+        return latency * (1 + self.error_penalty * endpoint.error_rate)
+
+    def choose(self, stream=False, exclude=()):
+        """Pick the endpoint for the next request, or None if all have been tried"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            available = [e for e in candidates if e.state(now) != "open"]
+            if not available:
+                # Every circuit is open: fail open on the one closest to its trial
+                return min(candidates, key=lambda e: e.open_until)
+            if len(available) > 1 and random.random() < self.explore:
+                endpoint = random.choice(available)
+            else:
+                endpoint = min(available, key=lambda e: self.score(e, stream))
+            if endpoint.state(now) == "half_open":
+                endpoint.probing = True
+            return endpoint
+
+    def record(self, endpoint, stream, seconds, ok):
+        with self._lock:
+            endpoint.error_rate += self.alpha * ((0.0 if ok else 1.0) - endpoint.error_rate)
+            endpoint.probing = False
+            if ok:
+                previous = endpoint.latency.get(stream)
+                endpoint.latency[stream] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+                if stream:
+                    endpoint.ttfts.append(seconds)
+                endpoint.failures = 0
+                endpoint.open_until = 0.0
+            else:
+                endpoint.failures += 1
+                if endpoint.failures >= self.breaker_failures or endpoint.open_until:
+                    endpoint.open_until = time.monotonic() + self.breaker_cooldown
+
+    def abandon(self, endpoint):
+        """Forget a request without judging the endpoint by it (e.g. a cancelled hedge)"""
+        with self._lock:
+            endpoint.probing = False
+
+    def hedge_delay(self, endpoint):
+        """Seconds to wait for a first token before hedging, or None to not hedge"""
+        if self.hedge_percentile <= 0:
+            return None
+        with self._lock:
+            samples = sorted(endpoint.ttfts)
+        if len(samples) < self.hedge_min_samples:
+            return None
+        rank = max(1, math.ceil(self.hedge_percentile / 100 * len(samples)))
+        return max(self.hedge_min_delay, samples[rank - 1])
+
+    # Requests
+    def _start(self, endpoint, payload, stream, retries, tried):
+        hedge_after = self.hedge_delay(endpoint) if stream else None
+        if hedge_after is None:
+            attempt = _Attempt(self, endpoint, payload, stream, retries)
+            attempt.run()
+            return attempt
+
+        done = queue.Queue()
+        primary = _Attempt(self, endpoint, payload, stream, retries, done)
+        threading.Thread(target=primary.run, daemon=True).start()
+        try:
+            return done.get(timeout=hedge_after)
+        except queue.Empty:
+            pass
+
+        # Only one endpoint configured: hedging on the same one still beats a slow instance
+        backup = _Attempt(self, self.choose(stream, exclude=tried) or endpoint, payload, stream, 0, done)
+        threading.Thread(target=backup.run, daemon=True).start()
+        winner = done.get()
+        if winner.failed:
+            other = done.get()
+            if other.failed:
+                other.cancel()
+            else:
+                winner.cancel()
+                winner = other
+        else:
+            (backup if winner is primary else primary).cancel()
+        LLM_HEDGES.inc(winner="backup" if winner is backup else "primary")
+        return winner
+
+    def open(self, payload, stream=False):
+        """Send ``payload`` to the best endpoint, failing over on errors; returns an ``UpstreamCall``
+
+        For streams this returns once the first token (or an error) arrived.
+        If every endpoint failed, the last response is returned, or its
+        exception raised. The caller must ``close()`` the call.
+        """
+        tried = []
+        attempt = None
+        while True:
+            endpoint = self.choose(stream, exclude=tried)
+            if endpoint is None:
+                break
+            if attempt is not None:
+                attempt.close()
+                LLM_FAILOVERS.inc()
+            tried.append(endpoint)
+            # Retrying the same endpoint only makes sense once there is nothing to fail over to
+            retries = None if len(tried) == len(self.endpoints) else 0
+            attempt = self._start(endpoint, payload, stream, retries, tried)
+            if not attempt.failed or isinstance(attempt.error, AdmissionError):
+                break
+        if attempt.error is not None:
+            attempt.close()
+            raise attempt.error
+        return UpstreamCall(attempt)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                "name": e.name,
+                "model": e.model,
+                "state": e.state(now),
+                "latency": dict((("stream" if k else "complete"), v) for k, v in e.latency.items()),
+                "error_rate": e.error_rate,
+                "consecutive_failures": e.failures
+            } for e in self.endpoints]
+
+    def collect(self):
+        """Per-endpoint gauges for /metrics"""
+        stats = self.stats()
+        latency = {}
+        for s in stats:
+            for kind, value in s["latency"].items():
+                latency[(("endpoint", s["name"]), ("kind", kind))] = value
+        return [
+            ("llm_endpoint_latency_seconds", "EWMA latency used for routing", latency),
+            ("llm_endpoint_error_rate", "EWMA error rate used for routing",
+             {(("endpoint", s["name"]),): s["error_rate"] for s in stats}),
+            ("llm_endpoint_circuit_open", "1 while the endpoint's circuit breaker is open",
+             {(("endpoint", s["name"]),): int(s["state"] == "open") for s in stats})
+        ]
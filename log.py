@@ -0,0 +1,215 @@
+"""Structured logging that never blocks a request
+
+Records are put on a bounded in-memory queue by a ``QueueHandler`` and
+written to stdout by a ``QueueListener`` thread, so a slow log sink only ever
+delays that thread. When the queue is full new records are dropped (and
+counted in ``log_records_dropped_total``) instead of stalling the worker.
+Under gevent the listener runs on a real OS thread (a patched one would be a
+greenlet, and a blocking write to stdout would freeze the whole worker), fed
+by an unpatched queue that greenlets can put on without a hub switch.
+
+Inside a request every record carries ``request_id``, ``user_id`` and
+``elapsed_ms`` (time since the request started). ``LOG_SAMPLE_RATES`` keeps
+only a fraction of records per level, e.g. ``DEBUG=0.01,INFO=0.1``; WARNING
+and above are kept unless configured otherwise.
+"""
+import os, sys, json, time, queue, _queue, random, atexit, logging, logging.handlers
+
+from flask import g, has_request_context
+
+from metrics import counter
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json or text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+LOG_RECORDS_DROPPED = counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+
+# Attributes every LogRecord has; anything else was passed via ``extra``
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def parse_sample_rates(spec):
+    """``"DEBUG=0.01,INFO=0.5"`` -> ``{10: 0.01, 20: 0.5}``"""
+    rates = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        level, rate = item.split("=", 1)
+        level = logging.getLevelName(level.strip().upper())
+        if isinstance(level, int):
+            rates[level] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+
+class RequestContextFilter(logging.Filter):
+    """Attach request id, user id and elapsed time while still on the request thread"""
+
+    def filter(self, record):
+        if has_request_context():
+            if not hasattr(record, "request_id"):
+                record.request_id = g.get("request_id")
+            if not hasattr(record, "user_id"):
+                record.user_id = g.get("user_id")
+            started = g.get("request_started")
+            if started is not None and not hasattr(record, "elapsed_ms"):
+                record.elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        return rate is None or rate >= 1.0 or random.random() < rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+    def prepare(self, record):
+        # The queue never leaves the process, so message formatting (and the
+        # record copy the base class makes for pickling) is left to the listener
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = [f"{key}={value}" for key, value in vars(record).items()
+                  if key not in _STANDARD_ATTRS and value is not None]
+        return f"{line} {' '.join(fields)}" if fields else line
+
+
+def _gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:  # gevent is optional
+        return False
+    return monkey.is_module_patched("threading")
+
+
+class _NativeQueue:
+    """Bounded queue that greenlets and a real OS thread can share
+
+    ``queue.Queue`` is built on whatever ``threading`` locks exist when it is
+    created, which under gevent only work inside the hub's thread; the C
+    ``SimpleQueue`` is left alone by gevent and never blocks on put.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._queue = _queue.SimpleQueue()
+
+    def put_nowait(self, item):
+        if 0 < self.maxsize <= self._queue.qsize():
+            raise queue.Full
+        self._queue.put_nowait(item)
+
+    def get(self, block=True, timeout=None):
+        return self._queue.get(block, timeout)
+
+
+class _NativeThread:
+    """The part of ``threading.Thread`` QueueListener uses, on an unpatched thread"""
+
+    def __init__(self, target):
+        from gevent import monkey
+        self._target = target
+        self._start_new_thread = monkey.get_original("_thread", "start_new_thread")
+        self._done = monkey.get_original("_thread", "allocate_lock")()
+
+    def start(self):
+        self._done.acquire()
+        self._start_new_thread(self._run, ())
+
+    def _run(self):
+        try:
+            self._target()
+        finally:
+            self._done.release()
+
+    def join(self):
+        with self._done:
+            pass
+
+
+class _Listener(logging.handlers.QueueListener):
+    def start(self):
+        if not _gevent_patched():
+            return super().start()
+        self._thread = _NativeThread(self._monitor)
+        self._thread.start()
+
+
+def _new_queue():
+    return _NativeQueue(LOG_QUEUE_SIZE) if _gevent_patched() else queue.Queue(LOG_QUEUE_SIZE)
+
+
+_listener = None
+
+
+def _start_listener(queue_handler, handler):
+    global _listener
+    _listener = _Listener(queue_handler.queue, handler, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_after_fork(queue_handler, handler):
+    # Threads do not survive fork (gunicorn --preload) and the old queue's lock
+    # may have been held by the parent's listener, so start over with a fresh one
+    queue_handler.queue = _new_queue()
+    _start_listener(queue_handler, handler)
+
+
+def setup_logging():
+    """Route the root logger through the background queue (idempotent)"""
+    if _listener is not None:
+        return
+    queue_handler = NonBlockingQueueHandler(_new_queue())
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+    queue_handler.addFilter(RequestContextFilter())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+    _start_listener(queue_handler, stream_handler)
+    os.register_at_fork(after_in_child=lambda: _restart_after_fork(queue_handler, stream_handler))
+    atexit.register(flush_logs)
+
+
+def flush_logs():
+    """Write out everything still queued; logging keeps working afterwards"""
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
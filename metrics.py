@@ -0,0 +1,187 @@
+"""Minimal Prometheus metrics (text exposition format 0.0.4)
+
+Counters and histograms live in process memory, so under gunicorn each
+worker reports its own series; scrape every worker (or put a single worker
+behind the scrape target) to aggregate. Collectors registered with
+``register_collector`` are called on every scrape and may return gauge values
+computed on the fly, e.g. cache statistics.
+"""
+import os, threading, time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, **labels):
+        """Context manager observing the duration of the ``with`` block"""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', _number(bound))])} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(series[-2])}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+_metrics = []
+_collectors = []
+
+
+def counter(name, documentation, labelnames=()):
+    metric = Counter(name, documentation, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, documentation, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(collect):
+    """``collect()`` returns ``[(name, documentation, {labels tuple: value})]`` rendered as gauges"""
+    _collectors.append(collect)
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, documentation, samples in collect():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples.items():
+                lines.append(f"{name}{_labels([k for k, _ in labels], [v for _, v in labels])} {_number(value)}")
+    lines.append(f'process_info{{pid="{os.getpid()}"}} 1')
+    return "\n".join(lines) + "\n"
+
+
+# Application metrics
+S3_REQUEST_SECONDS = histogram("s3_request_seconds", "Latency of S3 calls by operation and HTTP status", ["operation", "status"])
+LLM_REQUEST_SECONDS = histogram("llm_request_seconds", "Upstream LLM request latency until the response is closed", ["stream"])
+LLM_TTFT_SECONDS = histogram("llm_time_to_first_token_seconds", "Time from sending a streaming request to its first content delta")
+LLM_RESPONSES = counter("llm_responses_total", "Upstream LLM responses by status (200, 429, error)", ["status"])
+LLM_TOKENS = counter("llm_tokens_total", "Token usage reported by the upstream", ["type"])
+TEMPLATE_RENDER_SECONDS = histogram("template_render_seconds", "Jinja template render time", ["template"])
+HTTP_REQUEST_SECONDS = histogram("http_request_seconds", "Total request time including streamed bodies",
+                                 ["endpoint", "method", "status"])
+
+
+def upstream_status_label(status_code):
+    if status_code in (200, 429):
+        return str(status_code)
+    return "error"
+
+
+def record_usage(usage):
+    """Count tokens from an OpenAI-style ``usage`` object"""
+    if not isinstance(usage, dict):
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        value = usage.get(kind)
+        if isinstance(value, (int, float)):
+            LLM_TOKENS.inc(value, type=kind.replace("_tokens", ""))
+
+
+def instrument_s3(client):
+    """Time every API call made through a boto3 S3 client using botocore's event hooks"""
+    def before(context, **kwargs):
+        context["metrics_started"] = time.perf_counter()
+
+    def after(http_response, model, context, **kwargs):
+        started = context.get("metrics_started")
+        if started is not None:
+            S3_REQUEST_SECONDS.observe(time.perf_counter() - started, operation=model.name,
+                                       status=http_response.status_code)
+
+    def after_error(model, context, **kwargs):
+        # Connection errors and timeouts, no HTTP response
+        started = context.get("metrics_started")
+        if started is not None:
+            S3_REQUEST_SECONDS.observe(time.perf_counter() - started, operation=model.name, status="error")
+
+    client.meta.events.register("before-call.s3", before)
+    client.meta.events.register("after-call.s3", after)
+    client.meta.events.register("after-call-error.s3", after_error)
+    return client
@@ -0,0 +1,91 @@
+"""Optional cache of model replies for repeated prompts
+
+Keyed on (character, model, normalized message, hash of the prompt context),
+so a cached reply is only reused when the model would have seen the same
+prompt. Up to ``variants`` different replies are kept per key and one is
+picked at random; while a key has fewer than that, a hit still goes upstream
+with probability ``refresh_probability`` to collect another variant, so
+popular openers don't all get the identical answer.
+"""
+import os, hashlib, json, random, re, threading, time
+from collections import OrderedDict
+
+REPLY_CACHE_ENABLED = os.getenv("REPLY_CACHE_ENABLED", "false").lower() == "true"
+REPLY_CACHE_SIZE = int(os.getenv("REPLY_CACHE_SIZE", "2048"))
+REPLY_CACHE_TTL = float(os.getenv("REPLY_CACHE_TTL", "3600"))
+REPLY_CACHE_VARIANTS = int(os.getenv("REPLY_CACHE_VARIANTS", "3"))
+REPLY_CACHE_REFRESH_PROBABILITY = float(os.getenv("REPLY_CACHE_REFRESH_PROBABILITY", "0.25"))
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_message(message):
+    """Case- and whitespace-insensitive form, ignoring trailing punctuation"""
+    return _whitespace.sub(" ", message).strip().lower().rstrip(".!?~ ")
+
+
+def context_hash(messages):
+    """Stable digest of the prompt messages that precede the user's message"""
+    encoded = json.dumps(messages, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+class ReplyCache:
+    def __init__(self, enabled=REPLY_CACHE_ENABLED, max_entries=REPLY_CACHE_SIZE, ttl=REPLY_CACHE_TTL,
+                 variants=REPLY_CACHE_VARIANTS, refresh_probability=REPLY_CACHE_REFRESH_PROBABILITY):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = variants
+        self.refresh_probability = refresh_probability
+        self._entries = OrderedDict()  # key -> (created, [replies])
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._refreshes = 0
+
+    @staticmethod
+    def key(character, model, message, context):
+        return (character, model, normalize_message(message), context_hash(context))
+
+    def get(self, key):
+        """Return a cached reply, or None when the caller should ask the model"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            replies = entry[1]
+            if len(replies) < self.variants and random.random() < self.refresh_probability:
+                self._refreshes += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return random.choice(replies)
+
+    def put(self, key, reply):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                entry = self._entries[key] = (time.monotonic(), [])
+            if reply not in entry[1] and len(entry[1]) < self.variants:
+                entry[1].append(reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses + self._refreshes
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "refreshes": self._refreshes,
+                "hit_rate": self._hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,91 @@
+"""Shared S3 client and one-time bucket bootstrap
+
+Nothing here touches the network at import time. The client is created on
+first use (boto3 client creation is local, credentials are resolved lazily),
+and bucket configuration is applied explicitly with ``flask --app app
+bootstrap-s3`` rather than on every worker boot.
+"""
+import os, logging, json, threading
+
+import boto3
+from botocore.config import Config
+
+from metrics import instrument_s3
+
+# S3 and AWS Configuration
+S3_BUCKET = os.getenv("S3_BUCKET")
+AWS_REGION = os.getenv("AWS_REGION", "us-east-1")  # Default to us-east-1 if not specified
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT", "5"))
+S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", "10"))
+
+log = logging.getLogger(__name__)
+
+_s3_client = None
+_lock = threading.Lock()
+
+
+def get_s3_client():
+    """Return the process-wide S3 client, creating it on first use"""
+    global _s3_client
+    if _s3_client is None:
+        with _lock:
+            if _s3_client is None:
+                _s3_client = instrument_s3(boto3.client(
+                    "s3",
+                    region_name=AWS_REGION,
+                    config=Config(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        connect_timeout=S3_CONNECT_TIMEOUT,
+                        read_timeout=S3_READ_TIMEOUT
+                    )
+                ))
+    return _s3_client
+
+
+def set_s3_client(client):
+    """Replace the shared client (e.g. with a local stand-in)"""
+    global _s3_client
+    with _lock:
+        _s3_client = client
+
+
+def bootstrap_bucket():
+    """Configure S3 bucket with CORS and public read access for character images"""
+    if not S3_BUCKET:
+        log.error("No S3 bucket configured")
+        return False
+
+    s3_client = get_s3_client()
+    try:
+        cors_configuration = {
+            'CORSRules': [{
+                'AllowedHeaders': ['*'],
+                'AllowedMethods': ['GET', 'HEAD'],
+                'AllowedOrigins': ['*'],  # In production, replace with specific origins
+                'ExposeHeaders': ['ETag'],
+                'MaxAgeSeconds': 3000
+            }]
+        }
+        s3_client.put_bucket_cors(Bucket=S3_BUCKET, CORSConfiguration=cors_configuration)
+        log.info("Configured CORS for bucket %s", S3_BUCKET)
+
+        bucket_policy = {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Sid": "PublicReadForGetBucketObjects",
+                    "Effect": "Allow",
+                    "Principal": "*",
+                    "Action": "s3:GetObject",
+                    "Resource": f"arn:aws:s3:::{S3_BUCKET}/character_images/*"
+                }
+            ]
+        }
+        s3_client.put_bucket_policy(Bucket=S3_BUCKET, Policy=json.dumps(bucket_policy))
+        log.info("Set bucket policy for %s", S3_BUCKET)
+        return True
+
+    except Exception as e:
+        log.error("Error configuring S3 bucket %s: %s", S3_BUCKET, e)
+        return False
@@ -0,0 +1,26 @@
+import os, sys, threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "bench")]
+
+
+@pytest.fixture
+def s3_client():
+    """boto3 client for a fresh in-process fake S3 with bucket ``test``"""
+    import boto3
+    import fake_s3
+
+    server, _ = fake_s3.serve(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = boto3.client(
+        "s3",
+        endpoint_url=f"http://127.0.0.1:{server.server_address[1]}",
+        region_name="us-east-1",
+        aws_access_key_id="test",
+        aws_secret_access_key="test"
+    )
+    client.create_bucket(Bucket="test")
+    yield client
+    server.shutdown()
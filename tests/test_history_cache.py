@@ -0,0 +1,62 @@
+import time
+
+from botocore.exceptions import ClientError
+
+from history_cache import HistoryCache
+from history_store import HistoryStore
+
+
+def turn(i):
+    return [{"role": "user", "content": f"message {i}", "chatId": "c1"}]
+
+
+def flush_turns(cache, count):
+    for i in range(count):
+        cache.append("u1", turn(i))
+        cache.flush(force=True)
+
+
+def test_failed_compaction_after_commit_is_not_requeued(s3_client):
+    store = HistoryStore("test", s3_client=s3_client, compact_segments=2)
+
+    def compact(user_id, force=False):
+        raise RuntimeError("compaction failed")
+    store.compact = compact
+    cache = HistoryCache(store, flush_interval=0)
+
+    flush_turns(cache, 6)
+
+    assert [m["content"] for m in store.load("u1")] == [f"message {i}" for i in range(6)]
+    assert cache.stats()["flush_errors"] == 0
+    assert cache.stats()["pending_messages"] == 0
+
+
+def test_compaction_without_delete_permission_stores_each_turn_once(s3_client):
+    def denied(**kwargs):
+        raise ClientError({"Error": {"Code": "AccessDenied", "Message": "Access Denied"}}, "DeleteObjects")
+    s3_client.delete_objects = denied
+    store = HistoryStore("test", s3_client=s3_client, compact_segments=2)
+    cache = HistoryCache(store, flush_interval=0)
+
+    flush_turns(cache, 6)
+
+    assert [m["content"] for m in store.load("u1")] == [f"message {i}" for i in range(6)]
+    assert len(store.inspect("u1")["messages"]) == 6
+    assert cache.stats()["flush_errors"] == 0
+
+
+def test_load_keeps_batch_flushed_during_the_read(s3_client):
+    store = HistoryStore("test", s3_client=s3_client)
+    cache = HistoryCache(store, ttl=0.01, flush_interval=0)
+    cache.load("u1")
+    cache.append("u1", turn(0))
+    time.sleep(0.02)  # the cached copy expires, the batch is still queued
+
+    read = store.load
+    def load_then_flush(user_id):
+        history = read(user_id)  # read before the batch lands
+        cache.flush(force=True)
+        return history
+    store.load = load_then_flush
+
+    assert [m["content"] for m in cache.load("u1")] == ["message 0"]
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+from history_codec import HistoryCodec, zstandard
+from history_store import HistoryStore
+
+MESSAGES = [
+    {"role": "user", "content": "Hello, Sherlock", "chatId": "c1", "timestamp": 1},
+    {"role": "assistant", "content": "Élémentaire 🕵️", "chatId": "c1", "character": "Sherlock Holmes"},
+    {"role": "user", "content": "", "chatId": "c2", "timestamp": 3}
+]
+
+ENCODINGS = ["json", "gzip", pytest.param("zstd", marks=pytest.mark.skipif(
+    zstandard is None, reason="zstandard is not installed"))]
+
+
+@pytest.mark.parametrize("layout", ["rows", "columns"])
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_round_trip(encoding, layout):
+    codec = HistoryCodec(encoding=encoding, layout=layout)
+
+    messages, fmt = HistoryCodec.decode_with_format(codec.encode(MESSAGES))
+
+    assert messages == MESSAGES
+    assert fmt == f"{encoding}/{layout}"
+
+
+def test_plain_json_list_is_read_as_legacy_rows():
+    body = json.dumps(MESSAGES).encode("utf-8")
+
+    assert HistoryCodec.decode_with_format(body) == (MESSAGES, "json/rows")
+
+
+def test_unknown_columns_version_is_rejected():
+    with pytest.raises(ValueError):
+        HistoryCodec.decode(b'{"v": 99, "n": 0, "cols": {}}')
+
+
+def test_store_migrates_legacy_json_history(s3_client):
+    store = HistoryStore("test", s3_client=s3_client)
+    s3_client.put_object(Bucket="test", Key=store.legacy_key("u1"), Body=json.dumps(MESSAGES).encode("utf-8"))
+
+    assert store.load("u1") == MESSAGES
+    assert store.inspect("u1")["legacy"] is False
+    assert store.load("u1") == MESSAGES  # now from the segmented copy
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+from idempotency import IdempotencyMismatch, SingleFlight
+
+
+def join_in_thread(flights, key, fingerprint):
+    """Start a duplicate request; returns the thread and a list its (flight, result) lands in"""
+    outcome = []
+    thread = threading.Thread(target=lambda: outcome.append(flights.join(key, fingerprint)))
+    thread.start()
+    return thread, outcome
+
+
+def test_finish_replays_the_result_to_waiting_and_later_duplicates():
+    flights = SingleFlight()
+    key, fingerprint = SingleFlight.key("u1", "c1", "Sherlock", "hello", "k1")
+    flight, _ = flights.join(key, fingerprint)
+    thread, outcome = join_in_thread(flights, key, fingerprint)
+
+    flights.finish(key, flight, {"response": "hi"})
+    thread.join(timeout=5)
+
+    assert outcome == [(None, {"response": "hi"})]
+    assert flights.join(key, fingerprint) == (None, {"response": "hi"})
+
+
+def test_fail_lets_a_waiting_duplicate_take_over():
+    flights = SingleFlight()
+    key, fingerprint = SingleFlight.key("u1", "c1", "Sherlock", "hello")
+    flight, _ = flights.join(key, fingerprint)
+    thread, outcome = join_in_thread(flights, key, fingerprint)
+    time.sleep(0.05)  # let the duplicate start waiting
+
+    flights.fail(key, flight)
+    thread.join(timeout=5)
+
+    [(taken_over, result)] = outcome
+    assert taken_over is not None and taken_over is not flight
+    assert result is None
+
+
+def test_reusing_an_idempotency_key_for_another_message_is_rejected():
+    flights = SingleFlight()
+    key, fingerprint = SingleFlight.key("u1", "c1", "Sherlock", "hello", "k1")
+    flights.join(key, fingerprint)
+
+    other_key, other_fingerprint = SingleFlight.key("u1", "c1", "Sherlock", "goodbye", "k1")
+    assert other_key == key
+    with pytest.raises(IdempotencyMismatch):
+        flights.join(other_key, other_fingerprint)
+
+
+def test_automatic_key_expires_after_the_dedupe_window():
+    flights = SingleFlight(dedupe_window=0.05)
+    key, fingerprint = SingleFlight.key("u1", "c1", "Sherlock", "hello")
+    flight, _ = flights.join(key, fingerprint)
+    flights.finish(key, flight, {"response": "hi"})
+    assert flights.join(key, fingerprint) == (None, {"response": "hi"})
+
+    time.sleep(1.05)  # expired entries are pruned at most once a second
+
+    again, result = flights.join(key, fingerprint)
+    assert again is not None and result is None
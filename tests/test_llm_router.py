@@ -0,0 +1,70 @@
+from contextlib import contextmanager
+
+import pytest
+import requests
+
+from llm_router import Endpoint, LLMRouter
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeClient:
+    """Answers each URL with a fixed status code, or raises a connection error for None"""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.calls = []
+
+    @contextmanager
+    def post(self, url, retries=None, **kwargs):
+        self.calls.append(url)
+        status = self.statuses[url]
+        if status is None:
+            raise requests.ConnectionError(f"cannot reach {url}")
+        yield FakeResponse(status)
+
+
+def make_router(statuses, **kwargs):
+    endpoints = [Endpoint(name, name, "model") for name in statuses]
+    return LLMRouter(endpoints, FakeClient(statuses), explore=0, **kwargs)
+
+
+def test_failed_request_fails_over_to_the_next_endpoint():
+    router = make_router({"primary": 503, "backup": 200})
+
+    call = router.open({"messages": []})
+
+    assert call.endpoint.name == "backup"
+    assert router.client.calls == ["primary", "backup"]
+
+
+def test_breaker_opens_after_consecutive_failures_and_closes_after_a_good_trial():
+    router = make_router({"primary": None, "backup": 200}, breaker_failures=2, breaker_cooldown=60)
+    primary, backup = router.endpoints
+    primary.latency[False] = 0.0
+    backup.latency[False] = 1.0  # primary would win on latency alone
+
+    for _ in range(2):
+        router.open({"messages": []}).close()
+    assert primary.state(0) == "open"
+
+    router.client.calls.clear()
+    router.open({"messages": []}).close()
+    assert router.client.calls == ["backup"]
+
+    primary.open_until = 1e-9  # cooldown over
+    router.client.statuses["primary"] = 200
+    router.open({"messages": []}).close()
+    assert router.client.calls[-1] == "primary"
+    assert primary.state(0) == "closed"
+
+
+def test_error_from_the_last_endpoint_is_raised():
+    router = make_router({"primary": None, "backup": None})
+
+    with pytest.raises(requests.ConnectionError):
+        router.open({"messages": []})
+    assert router.client.calls == ["primary", "backup"]
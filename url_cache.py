@@ -0,0 +1,102 @@
+"""Expiry-aware cache for presigned S3 URLs
+
+A presigned URL stays valid for ``ExpiresIn`` seconds, so it is reused until
+``refresh_margin`` seconds before that. Keys that turned out not to exist are
+remembered for ``negative_ttl`` seconds so repeated lookups of a missing image
+do not hit S3 either.
+"""
+import os, threading, time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from metrics import S3_REQUEST_SECONDS
+
+URL_CACHE_SIZE = int(os.getenv("URL_CACHE_SIZE", "2048"))
+URL_CACHE_REFRESH_MARGIN = float(os.getenv("URL_CACHE_REFRESH_MARGIN", "300"))
+URL_CACHE_NEGATIVE_TTL = float(os.getenv("URL_CACHE_NEGATIVE_TTL", "60"))
+
+MISSING = object()
+
+
+class PresignedUrlCache:
+    def __init__(self, max_entries=URL_CACHE_SIZE, refresh_margin=URL_CACHE_REFRESH_MARGIN,
+                 negative_ttl=URL_CACHE_NEGATIVE_TTL):
+        self.max_entries = max_entries
+        self.refresh_margin = refresh_margin
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # cache key -> (url or MISSING, expires_at, reuse_until)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+
+    def _lookup(self, cache_key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None or now >= entry[2]:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            if entry[0] is MISSING:
+                self._negative_hits += 1
+            else:
+                self._hits += 1
+            return entry
+
+    def _store(self, cache_key, url, expires_at, reuse_until):
+        with self._lock:
+            self._entries[cache_key] = (url, expires_at, reuse_until)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def presign(self, s3_client, bucket, key, expires_in=3600, params=None, check_exists=False):
+        """Return ``(url, expires_at)`` for ``key``; ``url`` is None if the object does not exist
+
+        With ``check_exists`` the object is HEADed before signing and a 404 is
+        cached. Other S3 errors are raised and not cached.
+        """
+        extra = tuple(sorted((params or {}).items()))
+        cache_key = (bucket, key, expires_in, extra, check_exists)
+        entry = self._lookup(cache_key)
+        if entry is not None:
+            url, expires_at, _ = entry
+            return (None if url is MISSING else url), expires_at
+
+        if check_exists:
+            try:
+                s3_client.head_object(Bucket=bucket, Key=key)
+            except ClientError as e:
+                if e.response["Error"].get("Code", "") in ("404", "NoSuchKey"):
+                    now = time.time()
+                    self._store(cache_key, MISSING, now + self.negative_ttl, now + self.negative_ttl)
+                    return None, None
+                raise
+
+        now = time.time()
+        with S3_REQUEST_SECONDS.time(operation="GeneratePresignedUrl", status="local"):
+            url = s3_client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": bucket, "Key": key, **(params or {})},
+                ExpiresIn=expires_in
+            )
+        expires_at = now + expires_in
+        self._store(cache_key, url, expires_at, expires_at - min(self.refresh_margin, expires_in / 2))
+        return url, expires_at
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._negative_hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "negative_hits": self._negative_hits,
+                "misses": self._misses,
+                "hit_rate": (self._hits + self._negative_hits) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,132 @@
+"""Per-tab chat sessions for the WebSocket channel
+
+A session keeps what every message needs (user id, loaded history, active
+character) for as long as the tab is connected, so messages skip the per
+request setup. Every event sent to the client gets a sequence number and the
+last ``replay_size`` events are buffered. When a connection drops the session
+is kept for ``resume_ttl`` seconds; a reconnect that presents the session id
+and the last sequence number it saw gets the missed events replayed, including
+the rest of a reply that kept streaming while the tab was offline.
+
+Sessions live in the worker that accepted them, so resuming needs the
+reconnect to reach the same worker (sticky sessions); otherwise the client
+starts a new session and reloads its chat over HTTP.
+"""
+import os, json, time, uuid, logging, threading
+from collections import OrderedDict, deque
+
+from metrics import counter
+
+WS_RESUME_TTL = float(os.getenv("WS_RESUME_TTL", "120"))
+WS_REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "512"))  # events kept per session for replay
+WS_MAX_SESSIONS = int(os.getenv("WS_MAX_SESSIONS", "10000"))  # per worker
+
+WS_SESSIONS = counter("ws_sessions_total", "WebSocket chat connections by how their session started", ["kind"])
+
+log = logging.getLogger(__name__)
+
+
+class ChatSession:
+    def __init__(self, user_id, history, character, replay_size=WS_REPLAY_BUFFER):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.history = history
+        self.character = character
+        self.seq = 0
+        self.turn_lock = threading.Lock()  # one reply at a time, even across a reconnect
+        self._events = deque(maxlen=replay_size)
+        self._lock = threading.Lock()
+        self._ws = None
+        self.detached_at = time.monotonic()
+
+    @property
+    def connected(self):
+        return self._ws is not None
+
+    def emit(self, event):
+        """Number, buffer and (if connected) send one event; a failed send only detaches the socket"""
+        with self._lock:
+            self.seq += 1
+            event = {**event, "seq": self.seq}
+            self._events.append(event)
+            ws = self._ws
+            if ws is not None:
+                try:
+                    ws.send(json.dumps(event, ensure_ascii=False))
+                except Exception:
+                    self._detach(ws)
+
+    def send_unbuffered(self, event):
+        """Control messages (pong, ready) that are not replayed"""
+        with self._lock:
+            if self._ws is not None:
+                self._ws.send(json.dumps(event))
+
+    def attach(self, ws, last_seq=None):
+        """Make ws the session's connection, replaying events after last_seq; False if some were lost"""
+        with self._lock:
+            self._ws = ws
+            if last_seq is None:
+                return True
+            oldest = self._events[0]["seq"] if self._events else self.seq + 1
+            complete = last_seq >= oldest - 1
+            for event in self._events:
+                if event["seq"] > last_seq:
+                    ws.send(json.dumps(event, ensure_ascii=False))
+            return complete
+
+    def _detach(self, ws):
+        if self._ws is ws:
+            self._ws = None
+            self.detached_at = time.monotonic()
+
+    def detach(self, ws):
+        with self._lock:
+            self._detach(ws)
+
+
+class SessionRegistry:
+    def __init__(self, resume_ttl=WS_RESUME_TTL, max_sessions=WS_MAX_SESSIONS):
+        self.resume_ttl = resume_ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # id -> ChatSession, least recently attached first
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        expired = [sid for sid, s in self._sessions.items()
+                   if not s.connected and now - s.detached_at > self.resume_ttl]
+        for sid in expired:
+            del self._sessions[sid]
+
+    def open(self, user_id, session_id, load_session):
+        """(session, resumed) for a new connection
+
+        Resumes ``session_id`` if it is still known, belongs to user_id and
+        has no live connection (a duplicated tab carries the same id), otherwise
+        registers a new session from ``load_session()``.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            session = self._sessions.get(session_id) if session_id else None
+            if session is not None and session.user_id == user_id and not session.connected:
+                self._sessions.move_to_end(session_id)
+                WS_SESSIONS.inc(kind="resumed")
+                return session, True
+        session = load_session()
+        with self._lock:
+            self._sessions[session.id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        WS_SESSIONS.inc(kind="new")
+        return session, False
+
+    def user_sessions(self, user_id):
+        """Sessions of a user in this worker, e.g. to push a turn to the user's other tabs"""
+        with self._lock:
+            return [s for s in self._sessions.values() if s.user_id == user_id]
+
+    def stats(self):
+        with self._lock:
+            connected = sum(1 for s in self._sessions.values() if s.connected)
+            return {"sessions": len(self._sessions), "connected": connected}